@@ -2,15 +2,35 @@
 
 import argparse, json, sys, os.path
 from syrocr.getlines import getlines, drawboxes
-from syrocr.getchars import scanpage
-from syrocr.images import AvgIm
-from syrocr.gettext import verses
+from syrocr.getlines import renderpreview, renderpreviews, watchboxes
+from syrocr.getlines import PREVIEW_FORMATS
+from syrocr.getchars import scanpage, rematchpage, print_totals, GLYPHS_EXT
+from syrocr.tables import load_tables, save_tables
+from syrocr.tables import load_checkpoint, save_checkpoint, remove_checkpoint
+from syrocr.tables import compact_tables, merge_tables, remap_textlines
+from syrocr.gettext import verses, Corrections
+from syrocr.textlines import readtextlines, writetextlines, findtextlines
+from syrocr.textlines import TEXTLINES_EXT, COMPACT_TEXTLINES_EXT
 
 def command_getlines(args):
-    source_image = args.source_image
+    if args.queue:
+        from syrocr.workqueue import WorkQueue
+        # claim and process the images in directory source_image
+        queue = WorkQueue(args.queue, 'getlines')
+        src_files = {f.name: f.path for f in get_src_files(args.source_image)}
+        for name in queue.claim(list(src_files)):
+            if args.verbose:
+                print(f'Finding lines of {name}')
+            getlines_file(src_files[name], args)
+            queue.complete(name)
+    else:
+        getlines_file(args.source_image, args)
+
+def getlines_file(source_image, args):
     basename = os.path.basename(os.path.splitext(source_image)[0])
-    lines = getlines(source_image, dpi=(300,300), verbose=args.verbose)
-    im_lines = drawboxes(source_image, lines)
+    lines = getlines(source_image, dpi=(300,300), verbose=args.verbose,
+                     cache_dir=args.cache_dir)
+    im_lines = drawboxes(source_image, lines, cache_dir=args.cache_dir)
     im_lines.save(basename + '_lines.png', format="PNG")
     with open(basename + '_lines.json', 'w') as f:
         json.dump(lines, f, indent=2)
@@ -18,11 +38,31 @@ def command_getlines(args):
 def command_drawboxes(args):
     source_image = args.source_image
     json_file = args.json_file
-    basename = os.path.basename(os.path.splitext(source_image)[0])
-    with open(json_file) as f:
-        lines = json.load(f)
-    im_lines = drawboxes(source_image, lines)
-    im_lines.save(basename + '_lines.png', format="PNG")
+    ext = PREVIEW_FORMATS[args.format]
+    preview_args = (args.format, args.scale, args.cache_dir, args.font)
+    if os.path.isdir(source_image):
+        # render previews for all images in directory concurrently
+        jobs = []
+        for src_img_file in get_src_files(source_image):
+            base = os.path.splitext(src_img_file.name)[0]
+            json_lines_file = os.path.join(json_file, base + '_lines.json')
+            if not os.path.isfile(json_lines_file):
+                raise FileNotFoundError('not found:', json_lines_file)
+            jobs.append((src_img_file.path, json_lines_file,
+                         base + '_lines' + ext) + preview_args)
+        for preview_file in renderpreviews(jobs, args.jobs):
+            print(preview_file)
+    elif args.watch:
+        basename = os.path.basename(os.path.splitext(source_image)[0])
+        try:
+            watchboxes(source_image, json_file, basename + '_lines' + ext,
+                       *preview_args, verbose=args.verbose)
+        except KeyboardInterrupt:
+            pass
+    else:
+        basename = os.path.basename(os.path.splitext(source_image)[0])
+        renderpreview(source_image, json_file, basename + '_lines' + ext,
+                      *preview_args)
 
 def command_getchars(args):
     # TODO make this work both with directories and single files
@@ -32,43 +72,271 @@ def command_getchars(args):
     # optional settings, TODO set these in argparser
     src_ext = '.tif'
     json_ext = '_lines.json'
-    txtlines_ext = '_textlines.json'
-
-    if not args.reset and os.path.isfile(tables_file):
-        with open(tables_file, 'r') as f:
-            tables = json.load(f)
-        for textsize in tables:
-            for entry in tables[textsize]:
-                entry['avgim'] = AvgIm(
-                    entry['avgim']['base64_str'],
-                    entry['avgim']['baseline'],
-                    entry['avgim']['width'],
-                    entry['avgim']['height'])
+    txtlines_ext = COMPACT_TEXTLINES_EXT if args.compress else TEXTLINES_EXT
+
+    if args.cluster:
+        return cluster_getchars(args, source_img_dir, json_lines_dir,
+                                tables_file, src_ext, json_ext, txtlines_ext)
+
+    src_files = {os.path.splitext(f.name)[0]: f
+                 for f in get_src_files(source_img_dir, src_ext)}
+    if args.queue:
+        from syrocr.workqueue import WorkQueue
+        queue = WorkQueue(args.queue, 'getchars')
+        tables = queue.start(tables_file, reset=args.reset)
+        bases = queue.claim(list(src_files), wait=True,
+                            verbose=args.verbose)
     else:
-        tables = {'normal': [], 'small': []}
+        queue = None
+        tables, done = load_resume(args, tables_file)
+        bases = [base for base in src_files if base not in done]
+    classifiers = get_classifiers(args, tables)
 
-    for i, src_img_file in enumerate(get_src_files(source_img_dir, src_ext)):
-        base = os.path.splitext(src_img_file.name)[0]
+    for i, base in enumerate(bases):
+        src_img_file = src_files[base]
         json_lines_file = os.path.join(json_lines_dir, base + json_ext)
         if not os.path.isfile(json_lines_file):
-            raise FileNotFoundError('not found:', json_file)
+            raise FileNotFoundError('not found:', json_lines_file)
+        if args.glyphs:
+            glyphs_file = os.path.join(json_lines_dir, base + GLYPHS_EXT)
+        else:
+            glyphs_file = None
         if args.verbose:
             print(f'Scanning page {i}: {src_img_file.name}')
+        if queue is not None:
+            queue.update(tables)
+            num_entries = {textsize: len(tables[textsize]) for textsize in tables}
         textlines, tables = scanpage(src_img_file.path, json_lines_file, tables,
-                                     verbose=args.verbose)
+                                     verbose=args.verbose,
+                                     cache_dir=args.cache_dir,
+                                     glyphs_file=glyphs_file,
+                                     compare_args=get_compare_args(args),
+                                     classifiers=classifiers,
+                                     freeze_args=get_freeze_args(args),
+                                     cold_args=get_cold_args(args),
+                                     page=i)
+        if queue is not None:
+            textlines = remap_textlines(
+                textlines, queue.publish(tables, num_entries))
         # after scanning each page, save the textlines to a file
         json_text_file = os.path.join(json_lines_dir, base + txtlines_ext)
-        with open(json_text_file, 'w') as f:
-            json.dump(textlines, f, indent=2)
+        writetextlines(json_text_file, textlines)
+        if queue is not None:
+            queue.complete(base)
+        else:
+            checkpoint(args, tables, done, base, tables_file)
 
     # after all pages have been scanned, save tables to file
-    # TODO try converting avgim in json.dump with default serializer:
-    # https://stackoverflow.com/a/41200652
+    if queue is not None:
+        finish_queue(args, queue, tables, tables_file)
+    else:
+        save_tables(tables, tables_file)
+        remove_checkpoint(tables_file)
+
+def cluster_getchars(args, source_img_dir, json_lines_dir, tables_file,
+                     src_ext, json_ext, txtlines_ext):
+    from syrocr.cluster import segmentfiles, clusterpages
+    bases = []
+    jobs = []
+    for src_img_file in get_src_files(source_img_dir, src_ext):
+        base = os.path.splitext(src_img_file.name)[0]
+        json_lines_file = os.path.join(json_lines_dir, base + json_ext)
+        if not os.path.isfile(json_lines_file):
+            raise FileNotFoundError('not found:', json_lines_file)
+        if args.glyphs:
+            glyphs_file = os.path.join(json_lines_dir, base + GLYPHS_EXT)
+        else:
+            glyphs_file = None
+        bases.append(base)
+        jobs.append((src_img_file.path, json_lines_file, args.cache_dir,
+                     glyphs_file))
+
+    if args.verbose:
+        print(f'Segmenting {len(jobs)} pages')
+    pages = segmentfiles(jobs, args.jobs)
+    if args.verbose:
+        print('Clustering characters')
+    textpages, tables = clusterpages(pages, get_compare_args(args),
+                                     max_workers=args.jobs)
+
+    for base, textlines in zip(bases, textpages):
+        json_text_file = os.path.join(json_lines_dir, base + txtlines_ext)
+        writetextlines(json_text_file, textlines)
+    save_tables(tables, tables_file)
+    if args.verbose:
+        print_totals(tables)
+
+def command_rematch(args):
+    json_lines_dir = os.path.realpath(args.json_lines_dir)
+    tables_file = os.path.realpath(args.json_tables_file)
+    txtlines_ext = COMPACT_TEXTLINES_EXT if args.compress else TEXTLINES_EXT
+
+    glyphs_files = {f.name[:-len(GLYPHS_EXT)]: f
+                    for f in get_src_files(json_lines_dir, GLYPHS_EXT)}
+    if args.queue:
+        from syrocr.workqueue import WorkQueue
+        queue = WorkQueue(args.queue, 'rematch')
+        tables = queue.start(tables_file, reset=args.reset)
+        bases = queue.claim(list(glyphs_files), wait=True,
+                            verbose=args.verbose)
+    else:
+        queue = None
+        tables, done = load_resume(args, tables_file)
+        bases = [base for base in glyphs_files if base not in done]
+    classifiers = get_classifiers(args, tables)
+
+    for i, base in enumerate(bases):
+        if args.verbose:
+            print(f'Matching page {i}: {base}')
+        if queue is not None:
+            queue.update(tables)
+            num_entries = {textsize: len(tables[textsize]) for textsize in tables}
+        textlines = rematchpage(glyphs_files[base].path, tables,
+                                verbose=args.verbose,
+                                compare_args=get_compare_args(args),
+                                classifiers=classifiers,
+                                freeze_args=get_freeze_args(args),
+                                cold_args=get_cold_args(args),
+                                page=i)
+        if queue is not None:
+            textlines = remap_textlines(
+                textlines, queue.publish(tables, num_entries))
+        json_text_file = os.path.join(json_lines_dir, base + txtlines_ext)
+        writetextlines(json_text_file, textlines)
+        if queue is not None:
+            queue.complete(base)
+        else:
+            checkpoint(args, tables, done, base, tables_file)
+
+    if queue is not None:
+        finish_queue(args, queue, tables, tables_file)
+    else:
+        save_tables(tables, tables_file)
+        remove_checkpoint(tables_file)
+
+def load_resume(args, tables_file):
+    """Load the tables, or with --resume the last checkpoint
+
+    Returns:
+        (tables, done): the tables, and the list of pages they include
+    """
+    if args.resume:
+        checkpoint = load_checkpoint(tables_file)
+        if checkpoint is not None:
+            if args.verbose:
+                print(f'Resuming after {len(checkpoint[1])} pages')
+            return checkpoint
+    return load_tables(tables_file, reset=args.reset), []
+
+def checkpoint(args, tables, done, base, tables_file):
+    """Add page base to done, and save a checkpoint every args.checkpoint pages"""
+    done.append(base)
+    if args.checkpoint and len(done) % args.checkpoint == 0:
+        save_checkpoint(tables, done, tables_file)
+
+def finish_queue(args, queue, tables, tables_file):
+    """Merge the tables if we are the last worker, after all pages are done"""
+    if queue.finish(tables, tables_file):
+        if args.verbose:
+            print(f'Merged the tables of all workers into {tables_file}')
+        return
+    pending = queue.pending()
+    if pending:
+        print(f'Tables not merged into {tables_file} yet, the last of the '
+              f'workers {", ".join(pending)} will merge them. If a worker '
+              f'crashed, remove its file from {queue.workers_dir} and run '
+              f'a worker again.')
+
+def command_sweep(args):
+    from syrocr.sweep import sweep, getsettings, loadtruth
+    json_lines_dir = os.path.realpath(args.json_lines_dir)
+    glyphs_files = [f.path for f in get_src_files(json_lines_dir, GLYPHS_EXT)]
+    settings = getsettings(args.deviation, args.maxerror, args.absmax)
+    if args.truth_tables_file is not None:
+        truth_dir = args.truth_dir if args.truth_dir else json_lines_dir
+        truth = loadtruth(glyphs_files, truth_dir, args.truth_tables_file)
+    else:
+        truth = None
+
+    header = ('deviation', 'maxerror', 'absmax', 'normal', 'small',
+              'compares', 'seconds', 'accuracy')
+    print('\t'.join(header))
+    for result in sweep(glyphs_files, settings, truth, args.jobs):
+        if result.get('accuracy') is not None:
+            result['accuracy'] = f"{result['accuracy']:.4f}"
+        result['seconds'] = f"{result['seconds']:.1f}"
+        print('\t'.join(str(result.get(k, '')) for k in header), flush=True)
+
+def command_tables_compact(args):
+    json_textlines_dir = os.path.realpath(args.json_textlines_dir)
+    tables_file = os.path.realpath(args.json_tables_file)
+
+    tables = load_tables(tables_file)
+    new_tables, remap = compact_tables(tables, get_compare_args(args))
     for textsize in tables:
-        for entry in tables[textsize]:
-            entry['avgim'] = entry['avgim'].export()
-    with open(tables_file, 'w') as f:
-        json.dump(tables, f)
+        print(f'{textsize}: {len(tables[textsize])} -> '
+              f'{len(new_tables[textsize])} entries')
+    if args.dry_run:
+        return
+
+    for textlines_file in findtextlines(json_textlines_dir).values():
+        textlines = readtextlines(textlines_file)
+        writetextlines(textlines_file, remap_textlines(textlines, remap))
+        if args.verbose:
+            print(os.path.basename(textlines_file))
+    save_tables(new_tables, tables_file)
+
+def command_tables_merge(args):
+    inputs = [(os.path.realpath(json_textlines_dir),
+               os.path.realpath(json_tables_file))
+              for json_textlines_dir, json_tables_file in args.input]
+    tables_file = os.path.realpath(args.json_tables_file)
+
+    base = load_tables(os.path.realpath(args.base)) if args.base else None
+    tables = [load_tables(json_tables_file)
+              for json_textlines_dir, json_tables_file in inputs]
+    new_tables, remaps = merge_tables(tables, base, get_compare_args(args))
+    for textsize in new_tables:
+        counts = ' + '.join(str(len(t.get(textsize, []))) for t in tables)
+        print(f'{textsize}: {counts} -> {len(new_tables[textsize])} entries')
+    if args.dry_run:
+        return
+
+    for (json_textlines_dir, json_tables_file), remap in zip(inputs, remaps):
+        for textlines_file in findtextlines(json_textlines_dir).values():
+            textlines = readtextlines(textlines_file)
+            writetextlines(textlines_file, remap_textlines(textlines, remap))
+            if args.verbose:
+                print(os.path.basename(textlines_file))
+    save_tables(new_tables, tables_file)
+
+def command_convert(args):
+    from syrocr.textlines import convert
+    convert(os.path.realpath(args.json_textlines_dir),
+            compact=not args.json, verbose=args.verbose)
+
+def get_compare_args(args):
+    """Get arguments for AvgIm.compare() from parsed arguments"""
+    return {k: getattr(args, k) for k in ('deviation', 'maxerror', 'absmax')
+            if getattr(args, k) is not None}
+
+def get_freeze_args(args):
+    """Get arguments for AvgIm.add() from parsed arguments"""
+    return {k: getattr(args, k) for k in ('max_samples', 'max_stable')
+            if getattr(args, k) is not None}
+
+def get_cold_args(args):
+    """Get settings for the cold tier of the tables from parsed arguments"""
+    return {'min_pixels': args.cold_pixels, 'max_age': args.cold_age}
+
+def get_classifiers(args, tables):
+    """Get a Classifier for the keyed entries of every table, if requested"""
+    if not args.classify:
+        return None
+    from syrocr.classify import Classifier
+    return {textsize: Classifier(table, get_compare_args(args),
+                                 freeze_args=get_freeze_args(args))
+            for textsize, table in tables.items()}
 
 def get_src_files(src_dir, src_ext='.tif'):
     """Pair image files in src_dir with corresponding json files"""
@@ -83,7 +351,7 @@ def command_gettext(args):
         with open(args.corrections_file) as f:
             cf = yaml.safe_load(f)
         combinations = cf['combinations']
-        corrections = cf['corrections']
+        corrections = Corrections(cf['corrections'])
     else:
         combinations = None
         corrections = None
@@ -97,7 +365,9 @@ def command_gettext(args):
             meta=args.meta,
             spaces_file=args.spaces_file,
             combinations=combinations,
-            corrections=corrections):
+            corrections=corrections,
+            max_workers=args.jobs,
+            cache_dir=args.cache_dir):
         if not (verse or tag):
             # skip empty (first) verses
             continue
@@ -114,6 +384,13 @@ def command_gettext(args):
             print(f' {v:>2}', verse)
         else:
             print(f'{tag}\t{verse}')
+    if corrections is not None:
+        for correction, c_id in corrections.mismatched():
+            print(f'Correction {correction} not applied, found id {c_id}',
+                  file=sys.stderr)
+        for correction in corrections.unused():
+            print(f'Correction {correction} not applied, location not found',
+                  file=sys.stderr)
 
 if __name__ == "__main__":
     # initialize main argument parser
@@ -136,26 +413,127 @@ if __name__ == "__main__":
         '-v', '--verbose',
         help='increase output verbosity',
         action='store_true')
+    p_getlines.add_argument(
+        '-c', '--cache-dir',
+        help='Directory with cached decoded page images',
+        metavar='DIRNAME')
+    p_getlines.add_argument(
+        '-q', '--queue',
+        help='shared work queue directory: process the images in directory '
+             'source_image that no other worker claimed',
+        metavar='DIRNAME')
     p_getlines.add_argument(
         'source_image',
-        help='Filename of source image')
+        help='Filename of source image, or directory with --queue')
     p_getlines.set_defaults(func=command_getlines)
 
     # initialize subparser p_drawboxes
     p_drawboxes = subparsers.add_parser(
         'drawboxes',
         help='Draw boxes around lines on source image')
+    p_drawboxes.add_argument(
+        '-v', '--verbose',
+        help='increase output verbosity',
+        action='store_true')
+    p_drawboxes.add_argument(
+        '-w', '--watch',
+        help='update the preview image every time the json file changes',
+        action='store_true')
+    p_drawboxes.add_argument(
+        '-c', '--cache-dir',
+        help='Directory with cached decoded page images',
+        metavar='DIRNAME')
+    p_drawboxes.add_argument(
+        '-f', '--format',
+        help='Image format of preview image (default: %(default)s)',
+        choices=PREVIEW_FORMATS,
+        default='png')
+    p_drawboxes.add_argument(
+        '-s', '--scale',
+        help='Scale factor of preview image (default: %(default)s)',
+        type=float,
+        default=1)
+    p_drawboxes.add_argument(
+        '-j', '--jobs',
+        help='Number of processes for directories (default: number of cpus)',
+        type=int)
+    p_drawboxes.add_argument(
+        '--font',
+        help='Filename of TrueType font file',
+        metavar='FILENAME')
     p_drawboxes.add_argument(
         'source_image',
-        help='Filename of source image')
+        help='Filename of source image, or directory with source images')
     p_drawboxes.add_argument(
         'json_file',
-        help='Filename of json file')
+        help='Filename of json file, or directory with json lines files')
     p_drawboxes.set_defaults(func=command_drawboxes)
 
-    # initialize subparser p_drawboxes
+    # initialize parent parser with options for character comparison
+    p_compare = argparse.ArgumentParser(add_help=False)
+    p_compare.add_argument(
+        '--deviation',
+        help='maximum deviation in pixels of width, height and baseline '
+             '(default: 2)',
+        type=int)
+    p_compare.add_argument(
+        '--maxerror',
+        help='maximum percentage of unmatched pixels (default: 1)',
+        type=float)
+    p_compare.add_argument(
+        '--absmax',
+        help='maximum absolute number of unmatched pixels (default: 8)',
+        type=int)
+
+    # initialize parent parser with options for updating the tables
+    p_update = argparse.ArgumentParser(add_help=False)
+    p_update.add_argument(
+        '--max-samples',
+        help='stop updating the average image of an entry after N samples',
+        metavar='N',
+        type=int)
+    p_update.add_argument(
+        '--max-stable',
+        help='stop updating the average image of an entry after it did '
+             'not change in K updates',
+        metavar='K',
+        type=int)
+    p_update.add_argument(
+        '--cold-pixels',
+        help='search new entries with fewer than N pixels only after '
+             'all other entries',
+        metavar='N',
+        type=int)
+    p_update.add_argument(
+        '--cold-age',
+        help='search entries that were not matched in N pages only after '
+             'all other entries',
+        metavar='N',
+        type=int)
+    p_update.add_argument(
+        '-k', '--classify',
+        help='first label characters with the nearest entry with a key, '
+             'and compare with all entries only if that is ambiguous',
+        action='store_true')
+
+    # initialize parent parser with options for interrupted runs
+    p_resume = argparse.ArgumentParser(add_help=False)
+    p_resume.add_argument(
+        '--checkpoint',
+        help='save the tables and the finished pages every N pages, '
+             'without --queue (default: 10, 0 to disable)',
+        metavar='N',
+        type=int,
+        default=10)
+    p_resume.add_argument(
+        '--resume',
+        help='continue from the last checkpoint of an interrupted run',
+        action='store_true')
+
+    # initialize subparser p_getchars
     p_getchars = subparsers.add_parser(
         'getchars',
+        parents=[p_compare, p_update, p_resume],
         help='Recognize individual characters')
     p_getchars.add_argument(
         '-v', '--verbose',
@@ -165,6 +543,32 @@ if __name__ == "__main__":
         '-r', '--reset',
         help='reset character tables',
         action='store_true')
+    p_getchars.add_argument(
+        '-c', '--cache-dir',
+        help='Directory with cached decoded page images',
+        metavar='DIRNAME')
+    p_getchars.add_argument(
+        '-g', '--glyphs',
+        help='store segmented characters, to be used by rematch',
+        action='store_true')
+    p_getchars.add_argument(
+        '--cluster',
+        help='build new tables by clustering the characters of all pages '
+             'at once, independent of page order',
+        action='store_true')
+    p_getchars.add_argument(
+        '-j', '--jobs',
+        help='Number of processes with --cluster (default: number of cpus)',
+        type=int)
+    p_getchars.add_argument(
+        '-z', '--compress',
+        help=f'write compressed textlines files ({COMPACT_TEXTLINES_EXT})',
+        action='store_true')
+    p_getchars.add_argument(
+        '-q', '--queue',
+        help='shared work queue directory: scan the pages that no other '
+             'worker claimed, and share new table entries',
+        metavar='DIRNAME')
     p_getchars.add_argument(
         'source_img_dir',
         help='Directory with source images')
@@ -176,6 +580,153 @@ if __name__ == "__main__":
         help='Filename of json tables file')
     p_getchars.set_defaults(func=command_getchars)
 
+    # initialize subparser p_rematch
+    p_rematch = subparsers.add_parser(
+        'rematch',
+        parents=[p_compare, p_update, p_resume],
+        help='Recognize characters from glyphs stored by getchars')
+    p_rematch.add_argument(
+        '-v', '--verbose',
+        help='increase output verbosity',
+        action='store_true')
+    p_rematch.add_argument(
+        '-r', '--reset',
+        help='reset character tables',
+        action='store_true')
+    p_rematch.add_argument(
+        '-z', '--compress',
+        help=f'write compressed textlines files ({COMPACT_TEXTLINES_EXT})',
+        action='store_true')
+    p_rematch.add_argument(
+        '-q', '--queue',
+        help='shared work queue directory: match the pages that no other '
+             'worker claimed, and share new table entries',
+        metavar='DIRNAME')
+    p_rematch.add_argument(
+        'json_lines_dir',
+        help='Directory with json lines files and glyph files')
+    p_rematch.add_argument(
+        'json_tables_file',
+        help='Filename of json tables file')
+    p_rematch.set_defaults(func=command_rematch)
+
+    # initialize subparser p_sweep
+    p_sweep = subparsers.add_parser(
+        'sweep',
+        help='Compare results of comparison settings on stored glyphs')
+    p_sweep.add_argument(
+        '--deviation',
+        help='values for deviation (default: %(default)s)',
+        type=int,
+        nargs='+',
+        default=[2])
+    p_sweep.add_argument(
+        '--maxerror',
+        help='values for maxerror (default: %(default)s)',
+        type=float,
+        nargs='+',
+        default=[1])
+    p_sweep.add_argument(
+        '--absmax',
+        help='values for absmax (default: %(default)s)',
+        type=int,
+        nargs='+',
+        default=[8])
+    p_sweep.add_argument(
+        '-j', '--jobs',
+        help='Number of processes (default: number of cpus)',
+        type=int)
+    p_sweep.add_argument(
+        '-tt', '--truth-tables-file',
+        help='Filename of json tables file with keys, for accuracy',
+        metavar='FILENAME')
+    p_sweep.add_argument(
+        '-td', '--truth-dir',
+        help='Directory with reference json textlines files '
+             '(default: json_lines_dir)',
+        metavar='DIRNAME')
+    p_sweep.add_argument(
+        'json_lines_dir',
+        help='Directory with glyph files')
+    p_sweep.set_defaults(func=command_sweep)
+
+    # initialize subparser p_tables, with its own subcommands
+    p_tables = subparsers.add_parser(
+        'tables',
+        help='Maintain character tables')
+    tables_subparsers = p_tables.add_subparsers(
+        title='subcommands',
+        help='subcommand description:',
+        dest='tables_command',
+        metavar='<subcommand>')
+    p_tables.set_defaults(func=lambda args: p_tables.print_help())
+
+    # initialize subparser p_compact
+    p_compact = tables_subparsers.add_parser(
+        'compact',
+        parents=[p_compare],
+        help='Merge entries that match each other')
+    p_compact.add_argument(
+        '-v', '--verbose',
+        help='increase output verbosity',
+        action='store_true')
+    p_compact.add_argument(
+        '-n', '--dry-run',
+        help='only report the number of entries, do not write any files',
+        action='store_true')
+    p_compact.add_argument(
+        'json_textlines_dir',
+        help='Directory with json textlines files')
+    p_compact.add_argument(
+        'json_tables_file',
+        help='Filename of json tables file')
+    p_compact.set_defaults(func=command_tables_compact)
+
+    # initialize subparser p_merge
+    p_merge = tables_subparsers.add_parser(
+        'merge',
+        parents=[p_compare],
+        help='Merge tables made from separate sets of pages')
+    p_merge.add_argument(
+        '-v', '--verbose',
+        help='increase output verbosity',
+        action='store_true')
+    p_merge.add_argument(
+        '-n', '--dry-run',
+        help='only report the number of entries, do not write any files',
+        action='store_true')
+    p_merge.add_argument(
+        '-b', '--base',
+        help='Filename of json tables file that all input tables started from')
+    p_merge.add_argument(
+        '-i', '--input',
+        help='directory with json textlines files, and their json tables file',
+        nargs=2,
+        metavar=('JSON_TEXTLINES_DIR', 'JSON_TABLES_FILE'),
+        action='append',
+        required=True)
+    p_merge.add_argument(
+        'json_tables_file',
+        help='Filename of merged json tables file')
+    p_merge.set_defaults(func=command_tables_merge)
+
+    # initialize subparser p_convert
+    p_convert = subparsers.add_parser(
+        'convert',
+        help='Convert textlines files to the compressed format')
+    p_convert.add_argument(
+        '-v', '--verbose',
+        help='increase output verbosity',
+        action='store_true')
+    p_convert.add_argument(
+        '--json',
+        help='convert compressed textlines files back to json',
+        action='store_true')
+    p_convert.add_argument(
+        'json_textlines_dir',
+        help='Directory with json textlines files')
+    p_convert.set_defaults(func=command_convert)
+
     # initialize subparser p_gettext
     p_gettext = subparsers.add_parser(
         'gettext',
@@ -218,6 +769,14 @@ if __name__ == "__main__":
         '-M', '--meta',
         help='If set, include meta characters in output',
         action='store_true')
+    p_gettext.add_argument(
+        '-j', '--jobs',
+        help='Number of processes (default: number of cpus)',
+        type=int)
+    p_gettext.add_argument(
+        '-c', '--cache-dir',
+        help='Directory with cached processed pages',
+        metavar='DIRNAME')
     p_gettext.add_argument(
         '-ps', '--pil-style',
         help='Output verses in PIL style',
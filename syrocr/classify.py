@@ -0,0 +1,121 @@
+from .images import descriptor, distance, DEVIATION
+
+# a glyph is ambiguous if an entry with another transcription is less
+# than AMBIGUITY times as far away as the nearest entry
+AMBIGUITY = 1.5
+
+
+class Classifier:
+    '''Nearest neighbour classifier for the keyed entries of a table
+
+    The model consists of the descriptor of the black and white image
+    of every entry that has a key, and the range of widths, heights and
+    baselines that AvgIm.compare() accepts for it. Glyphs are labeled
+    with the nearest entry in range, which is confirmed with a single
+    comparison. Glyphs that are out of range of all entries, or for
+    which an entry with another transcription is nearly as close, or
+    that do not pass the comparison, are not labeled.
+
+    The distances of all glyphs of a line are calculated together,
+    with numpy if it is available.
+    '''
+
+    def __init__(self, table, compare_args=None, ambiguity=AMBIGUITY,
+                 freeze_args=None):
+        self.compare_args = compare_args if compare_args is not None else {}
+        self.freeze_args = freeze_args if freeze_args is not None else {}
+        self.ambiguity = ambiguity
+        deviation = self.compare_args.get('deviation', DEVIATION)
+        self.entries = [c for c in table if c['key'] is not None]
+        self.descriptors = [descriptor(c['avgim'].bw_im) for c in self.entries]
+        self.ranges = [
+            ((a.minwidth - deviation, a.maxwidth + deviation),
+             (a.minheight - deviation, a.maxheight + deviation),
+             (a.minbaseline - deviation, a.maxbaseline + deviation))
+            for a in (c['avgim'] for c in self.entries)]
+        labels = [(c['key']['tr'], c['key']['script']) for c in self.entries]
+        label_nums = {label: n for n, label in enumerate(sorted(set(labels)))}
+        self.labels = [label_nums[label] for label in labels]
+        try:
+            import numpy
+        except ImportError:
+            self.np = None
+        else:
+            self.np = numpy
+            self.np_descriptors = numpy.array(self.descriptors, dtype=numpy.int64)
+            self.np_ranges = numpy.array(self.ranges, dtype=numpy.int64)
+            self.np_labels = numpy.array(self.labels)
+
+    def classify(self, chars, update_avgim=True, stats=None):
+        """Find the keyed entries of a sequence of BoundIm characters
+
+        Returns:
+            list with for every character its entry, or None
+        """
+        if not chars or not self.entries:
+            return [None] * len(chars)
+        ims = [char.image().image for char in chars]
+        sizes = [(im.width, im.height, char.baseline)
+                 for im, char in zip(ims, chars)]
+        descriptors = [descriptor(im) for im in ims]
+        if self.np is not None:
+            nearest = self.nearest_numpy(descriptors, sizes)
+        else:
+            nearest = self.nearest(descriptors, sizes)
+        found = []
+        for n, char, im in zip(nearest, chars, ims):
+            c = None
+            if n is not None:
+                if stats is not None:
+                    stats['compares'] = stats.get('compares', 0) + 1
+                offset = self.entries[n]['avgim'].compare(
+                    im, char.baseline, **self.compare_args)
+                if offset:
+                    c = self.entries[n]
+                    if update_avgim:
+                        c['avgim'].add(im, char.baseline, offset,
+                                       **self.freeze_args)
+                    if c.get('cold') == 'age':
+                        c['cold'] = None
+            found.append(c)
+        return found
+
+    def nearest(self, descriptors, sizes):
+        """Give the unambiguous nearest entry number for every descriptor"""
+        found = []
+        for descr, size in zip(descriptors, sizes):
+            distances = [
+                (distance(descr, d), n) for n, (d, ranges) in
+                enumerate(zip(self.descriptors, self.ranges))
+                if all(lo <= v <= hi for v, (lo, hi) in zip(size, ranges))]
+            if not distances:
+                found.append(None)
+                continue
+            best, n = min(distances)
+            other = min((d for d, m in distances
+                         if self.labels[m] != self.labels[n]), default=None)
+            if other is not None and other <= best * self.ambiguity:
+                found.append(None)
+            else:
+                found.append(n)
+        return found
+
+    def nearest_numpy(self, descriptors, sizes):
+        """Vectorized version of nearest()"""
+        np = self.np
+        descriptors = np.array(descriptors, dtype=np.int64)
+        sizes = np.array(sizes, dtype=np.int64)
+        # distances of all glyphs (rows) to all entries (columns)
+        diff = descriptors[:, None, :] - self.np_descriptors[None, :, :]
+        distances = (diff * diff).sum(axis=2).astype(float)
+        inrange = ((self.np_ranges[None, :, :, 0] <= sizes[:, None, :])
+                   & (sizes[:, None, :] <= self.np_ranges[None, :, :, 1])
+                   ).all(axis=2)
+        distances[~inrange] = np.inf
+        best = distances.argmin(axis=1)
+        rows = np.arange(len(best))
+        best_distances = distances[rows, best]
+        others = np.where(self.np_labels[None, :] != self.np_labels[best][:, None],
+                          distances, np.inf).min(axis=1)
+        ambiguous = (others <= best_distances * self.ambiguity) | np.isinf(best_distances)
+        return [None if a else int(n) for n, a in zip(best, ambiguous)]
@@ -0,0 +1,243 @@
+import itertools
+from collections import Counter
+from PIL import Image
+from .images import AvgIm, compare, descriptor, distance, DEVIATION
+from .getchars import get_textsize, segmentfile, SECTIONS
+from .tables import TEXTSIZES
+
+# number of nearest preceding glyphs that every glyph is compared with
+NEIGHBOURS = 8
+# number of glyphs per task sent to a worker process
+CHUNKSIZE = 64
+
+# unique glyphs and their index, loaded once per worker process
+_glyphs = None
+
+
+def segmentfiles(jobs, max_workers=None):
+    """Segment pages in parallel
+
+    Arguments:
+        jobs: list of argument tuples for segmentfile().
+        max_workers: number of processes, default number of cpu's.
+
+    Returns:
+        list of segmented pages, in order of jobs
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers) as executor:
+        return list(executor.map(segmentfile, *zip(*jobs)))
+
+def clusterpages(pages, compare_args=None, neighbours=NEIGHBOURS,
+                 max_workers=None):
+    """Build new tables from the glyphs of all pages at once
+
+    Unlike matchpage(), which adds glyphs to the tables in the order in
+    which they are found, this clusters all glyphs together, so that
+    the result does not depend on the order of the pages.
+
+    Identical bitmaps are counted only once. The unique glyphs are put
+    in a canonical order, most frequent first, and every glyph is
+    compared with its nearest preceding neighbours, found with an index
+    on size and descriptor(). The comparisons are done in parallel.
+    Then, in canonical order, every glyph joins the cluster of the first
+    matching neighbour that leads a cluster, or else leads a new one.
+    Finally, clusters whose leader matches the average image of an
+    earlier cluster are merged with it.
+
+    Arguments:
+        pages: list of segmented pages, as returned by segmentpage().
+        compare_args: dict with optional arguments for AvgIm.compare().
+        neighbours: number of neighbours to compare every glyph with.
+        max_workers: number of processes, default number of cpu's.
+
+    Returns:
+        (textpages, tables): list of textlines per page, and the tables
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if compare_args is None:
+        compare_args = {}
+
+    # count unique bitmaps per textsize
+    keys = []
+    counts = {textsize: Counter() for textsize in TEXTSIZES}
+    for line, section, char, connections in iterglyphs(pages):
+        key = (get_textsize(line['type'], section), glyphkey(char))
+        counts[key[0]][key[1]] += 1
+        keys.append(key)
+
+    tables = {}
+    ids = {}
+    for textsize in TEXTSIZES:
+        count = counts[textsize]
+        glyphs = sorted(count, key=lambda g: (-count[g], g))
+        tables[textsize] = []
+        if not glyphs:
+            continue
+        with ProcessPoolExecutor(max_workers, initializer=_loadglyphs,
+                                 initargs=(glyphs,)) as executor:
+            chunks = [range(i, min(i + CHUNKSIZE, len(glyphs)))
+                      for i in range(0, len(glyphs), CHUNKSIZE)]
+            matches = itertools.chain.from_iterable(executor.map(
+                matchneighbours, chunks, itertools.repeat(compare_args),
+                itertools.repeat(neighbours)))
+            clusters = leaderclusters(list(matches), glyphs, compare_args)
+            avgims = list(executor.map(buildavgim, (
+                [(glyphs[i], count[glyphs[i]]) for i in cluster]
+                for cluster in clusters)))
+            # merge clusters that match the average of an earlier cluster,
+            # and rebuild the average images of the merged clusters
+            merged = mergeclusters(clusters, avgims, glyphs, compare_args,
+                                   neighbours)
+            changed = [n for n, cluster in enumerate(merged)
+                       if cluster and cluster != clusters[n]]
+            for n, avgim in zip(changed, executor.map(buildavgim, (
+                    [(glyphs[i], count[glyphs[i]]) for i in merged[n]]
+                    for n in changed))):
+                avgims[n] = avgim
+        for cluster, avgim in zip(merged, avgims):
+            if not cluster:
+                continue
+            c_id = len(tables[textsize])
+            tables[textsize].append({'id': c_id, 'avgim': avgim, 'key': None})
+            for i in cluster:
+                ids[(textsize, glyphs[i])] = c_id
+
+    # the glyphs are visited in the same order as when they were counted
+    keys = iter(keys)
+    textpages = []
+    for glyphlines in pages:
+        textlines = []
+        for line in glyphlines:
+            textline = {'num': line['num'], 'type': line['type']}
+            for section in SECTIONS:
+                textline[section] = []
+                for char, connections in line[section] or ():
+                    x, y = char.offset
+                    box = (x, y, x + char.width, y + char.height)
+                    c_id = ids[next(keys)]
+                    textline[section].append((c_id, connections, None, box))
+            textlines.append(textline)
+        textpages.append(textlines)
+
+    return textpages, tables
+
+def iterglyphs(pages):
+    for glyphlines in pages:
+        for line in glyphlines:
+            for section in SECTIONS:
+                for char, connections in line[section] or ():
+                    yield line, section, char, connections
+
+def glyphkey(char):
+    """Give hashable key of the bitmap and baseline of BoundIm char"""
+    im = char.image()
+    return (im.width, im.height, char.baseline, im.tobytes())
+
+def glyphimage(key):
+    width, height, baseline, data = key
+    return Image.frombytes('L', (width, height), data)
+
+def _loadglyphs(glyphs):
+    global _glyphs
+    images = [glyphimage(key) for key in glyphs]
+    descriptors = [descriptor(im) for im in images]
+    # index of glyph numbers by width and height
+    index = {}
+    for i, (width, height, baseline, data) in enumerate(glyphs):
+        index.setdefault((width, height), []).append(i)
+    _glyphs = glyphs, images, descriptors, index
+
+def matchneighbours(indices, compare_args, neighbours=NEIGHBOURS):
+    """Find preceding glyphs that match the glyphs with the given indices
+
+    Only glyphs within the deviation of width, height and baseline are
+    candidates, of which the number of neighbours closest by descriptor
+    are compared.
+
+    Returns:
+        list with, for every index, a sorted list of matching glyphs
+    """
+    glyphs, images, descriptors, index = _glyphs
+    deviation = compare_args.get('deviation', DEVIATION)
+    results = []
+    for i in indices:
+        width, height, baseline, data = glyphs[i]
+        candidates = []
+        for w, h in itertools.product(
+                range(width - deviation, width + deviation + 1),
+                range(height - deviation, height + deviation + 1)):
+            for j in index.get((w, h), ()):
+                if j >= i:
+                    break
+                if abs(glyphs[j][2] - baseline) <= deviation:
+                    candidates.append(j)
+        candidates.sort(key=lambda j: (distance(descriptors[i], descriptors[j]), j))
+        results.append(sorted(
+            j for j in candidates[:neighbours]
+            if AvgIm(images[j], glyphs[j][2]).compare(
+                images[i], baseline, **compare_args)))
+    return results
+
+def leaderclusters(matches, glyphs, compare_args):
+    """Group glyphs into clusters with the first glyph as leader
+
+    Glyphs are visited in order, and join the cluster of the first
+    glyph in their list of matches that is a leader. If none of them
+    is, the glyph is compared with the leaders of the matches instead.
+
+    Returns:
+        list of clusters, every cluster a list of glyph numbers
+    """
+    leader = []
+    clusters = {}
+    for i, js in enumerate(matches):
+        c = next((j for j in js if leader[j] == j), None)
+        if c is None:
+            im = glyphimage(glyphs[i])
+            c = next((leader[j] for j in js if AvgIm(
+                glyphimage(glyphs[leader[j]]), glyphs[leader[j]][2]).compare(
+                    im, glyphs[i][2], **compare_args)), i)
+        leader.append(c)
+        clusters.setdefault(c, []).append(i)
+    return list(clusters.values())
+
+def mergeclusters(clusters, avgims, glyphs, compare_args, neighbours=NEIGHBOURS):
+    """Merge clusters whose leader matches the AvgIm of an earlier cluster
+
+    Leaders are compared with the images of other glyphs only, which
+    leaves more clusters than matching against the (wider) averages.
+
+    Returns:
+        copy of clusters, with merged clusters emptied
+    """
+    deviation = compare_args.get('deviation', DEVIATION)
+    merged = [list(cluster) for cluster in clusters]
+    images = [glyphimage(glyphs[cluster[0]]) for cluster in clusters]
+    descriptors = [descriptor(im) for im in images]
+    into = []
+    for n, cluster in enumerate(clusters):
+        width, height, baseline, data = glyphs[cluster[0]]
+        candidates = [m for m in range(n) if into[m] == m
+                      and avgims[m].minwidth - deviation <= width <= avgims[m].maxwidth + deviation
+                      and avgims[m].minheight - deviation <= height <= avgims[m].maxheight + deviation]
+        candidates.sort(key=lambda m: (distance(descriptors[n], descriptors[m]), m))
+        m = next((m for m in sorted(candidates[:neighbours])
+                  if avgims[m].compare(images[n], baseline, **compare_args)), n)
+        into.append(m)
+        if m != n:
+            merged[m] = sorted(merged[m] + merged[n])
+            merged[n] = []
+    return merged
+
+def buildavgim(members):
+    """Make an AvgIm of the (glyph key, count) tuples in members"""
+    images = [(glyphimage(key), key[2], count) for key, count in members]
+    im, baseline, count = images[0]
+    avgim = AvgIm(im, baseline)
+    images[0] = (im, baseline, count - 1)
+    for im, baseline, count in images:
+        for n in range(count):
+            dens, offset = compare(avgim.bw_im, im)
+            avgim.add(im, baseline, offset)
+    return avgim
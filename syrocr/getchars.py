@@ -1,9 +1,19 @@
-import json
-from .images import Im, BoundIm, AvgIm, getboundaries
-
-def scanpage(src_img_file, lines_file, tables_file, verbose=False):
+import itertools, json, os
+from .images import Im, BoundIm, AvgIm, getboundaries, openpage, loadboundim, count
+from .tables import load_tables
+
+SECTIONS = ('main', 'marginl', 'marginr')
+# increase when changes to getcharacters() invalidate cached segmentations
+SEGMENTATION_VERSION = 1
+SEGMENT_CACHE_EXT = '.segments.json'
+GLYPHS_VERSION = 1
+GLYPHS_EXT = '_glyphs.json.gz'
+
+def scanpage(src_img_file, lines_file, tables_file, verbose=False, cache_dir=None,
+             glyphs_file=None, compare_args=None, classifiers=None,
+             freeze_args=None, cold_args=None, page=None):
     if type(src_img_file) is str:
-        im = Im(src_img_file)
+        im = openpage(src_img_file, cache_dir=cache_dir)
     else:
         im = src_img_file
 
@@ -14,35 +24,116 @@ def scanpage(src_img_file, lines_file, tables_file, verbose=False):
         lines = lines_file
 
     if type(tables_file) is str:
-        with open(tables_file, 'r') as f:
-            tables = json.load(f)
+        tables = load_tables(tables_file)
     else:
         tables = tables_file
 
-    if verbose:
-        # store number of entries in table for later reference
-        num_entries_page = {textsize:len(tables[textsize]) for textsize in tables}
+    glyphlines = segmentpage(im, lines, cache_dir)
+    if glyphs_file is not None:
+        writeglyphs(glyphs_file, glyphlines)
 
-    textlines = []
+    textlines = matchpage(glyphlines, tables, verbose, compare_args,
+                          classifiers=classifiers, freeze_args=freeze_args,
+                          cold_args=cold_args, page=page)
+
+    return textlines, tables
+
+def rematchpage(glyphs_file, tables, verbose=False, compare_args=None,
+                classifiers=None, freeze_args=None, cold_args=None, page=None):
+    """Match stored glyphs of a page, without segmenting the page again"""
+    return matchpage(readglyphs(glyphs_file), tables, verbose, compare_args,
+                     classifiers=classifiers, freeze_args=freeze_args,
+                     cold_args=cold_args, page=page)
+
+def segmentfile(src_img_file, lines_file, cache_dir=None, glyphs_file=None):
+    """Segment the lines in lines_file of page image src_img_file"""
+    im = openpage(src_img_file, cache_dir=cache_dir)
+    with open(lines_file, 'r') as f:
+        lines = json.load(f)
+    glyphlines = segmentpage(im, lines, cache_dir)
+    if glyphs_file is not None:
+        writeglyphs(glyphs_file, glyphlines)
+    return glyphlines
+
+def segmentpage(im, lines, cache_dir=None):
+    """Segment the sections of all lines of a page into characters
+
+    Returns:
+        list of dicts with the 'num', 'type' and 'baseline' of each line,
+        and per section a list of (BoundIm, connections) tuples, or None.
+    """
+    if cache_dir is not None:
+        segment_cache = SegmentCache(im, cache_dir)
+        getchars = segment_cache.getcharacters
+    else:
+        getchars = getcharacters
+
+    glyphlines = []
     for line in lines:
+        glyphline = {'num': line['num'], 'type': line['type'],
+                     'baseline': line['baseline']}
+        for section in SECTIONS:
+            if not line[section]:
+                glyphline[section] = None
+            else:
+                glyphline[section] = list(getchars(im, line[section], line['baseline']))
+        glyphlines.append(glyphline)
+
+    if cache_dir is not None:
+        segment_cache.save()
+
+    return glyphlines
+
+def matchpage(glyphlines, tables, verbose=False, compare_args=None, stats=None,
+              classifiers=None, freeze_args=None, cold_args=None, page=None):
+    """Find the characters of segmented lines in the tables
+
+    Unknown characters are added to the tables, and the average
+    images of found characters are updated. If stats is a dict,
+    the number of comparisons is added to stats['compares'].
+    If classifiers is a dict with a Classifier per textsize, the
+    characters of every line are first classified with it, and only
+    characters that it cannot label are looked up with findchar().
+    freeze_args is a dict with optional arguments for AvgIm.add(),
+    which determine when entries are frozen. cold_args is a dict with
+    optional values for 'min_pixels' and 'max_age', which determine
+    which entries are moved to the cold tier (see findchars()). For
+    'max_age', page must be the number of the page in the run.
+    """
+    # store number of entries in table for later reference
+    num_entries_page = {textsize:len(tables[textsize]) for textsize in tables}
+
+    textlines = []
+    for line in glyphlines:
         if verbose:
             print('Line', line['num'], '...', end=' ')
             # store number of entries in tables
             num_entries_line = {textsize:len(tables[textsize]) for textsize in tables}
         textline = {'num': line['num'], 'type': line['type']}
-        baseline = line['baseline']
-        for section in ('main', 'marginl', 'marginr'):
+        for section in SECTIONS:
             textline[section] = []
             if not line[section]:
                 continue
             textsize = get_textsize(line['type'], section)
             table = tables[textsize]
-            for char, connections in getcharacters(im, line[section], baseline):
+            chars = [char for char, connections in line[section]]
+            if classifiers is not None:
+                found = classifiers[textsize].classify(chars, stats=stats)
+            else:
+                found = [None] * len(chars)
+            # look up the remaining characters in the full table, in order
+            remaining = iter(findchars(
+                table, [char for char, c in zip(chars, found) if c is None],
+                update_avgim=True, add_to_table=True,
+                compare_args=compare_args, stats=stats,
+                freeze_args=freeze_args, cold_args=cold_args))
+            for (char, connections), c in zip(line[section], found):
                 x, y = char.offset
                 box = (x, y, x + char.width, y + char.height)
                 tr_override = None
 
-                c = findchar(table, char, update_avgim=True, add_to_table=True)
+                if c is None:
+                    c = next(remaining)
 
                 textline[section].append((c['id'], connections, tr_override, box))
 
@@ -51,11 +142,89 @@ def scanpage(src_img_file, lines_file, tables_file, verbose=False):
         if verbose:
             print_new_entries(tables, num_entries_line, 'line')
 
+    if (cold_args is not None and cold_args.get('max_age') is not None
+            and page is not None):
+        # remember the page on which new entries were made
+        for textsize, table in tables.items():
+            for entry in table[num_entries_page[textsize]:]:
+                entry['page'] = page
+        ageentries(tables, cold_args['max_age'], page)
+
     if verbose:
         print_new_entries(tables, num_entries_page, 'page')
         print_totals(tables)
 
-    return textlines, tables
+    return textlines
+
+def writeglyphs(glyphs_file, glyphlines):
+    """Write segmented lines to a gzipped json glyph store
+
+    Every character is stored as exported BoundIm, with its offset,
+    baseline and column boundaries (a run-length encoded bitmap),
+    together with its connections.
+    """
+    import gzip
+    store = {'version': GLYPHS_VERSION, 'lines': [
+        dict(line, **{section: None if line[section] is None
+                      else [(char.export(), connections)
+                            for char, connections in line[section]]
+                      for section in SECTIONS})
+        for line in glyphlines]}
+    tmp_file = f'{glyphs_file}.{os.getpid()}.tmp'
+    with gzip.open(tmp_file, 'wt') as f:
+        json.dump(store, f, separators=(',', ':'))
+    os.replace(tmp_file, glyphs_file)
+
+def readglyphs(glyphs_file):
+    """Read segmented lines from glyph store written with writeglyphs()"""
+    import gzip
+    with gzip.open(glyphs_file, 'rt') as f:
+        store = json.load(f)
+    if store['version'] != GLYPHS_VERSION:
+        raise ValueError('Unsupported glyph store version:', glyphs_file)
+    return [dict(line, **{section: None if line[section] is None
+                          else [(loadboundim(char), tuple(connections))
+                                for char, connections in line[section]]
+                          for section in SECTIONS})
+            for line in store['lines']]
+
+class SegmentCache:
+    '''Cache of getcharacters() results per line box of a page
+
+    The cache file of a page is named after a hash of the page bitmap,
+    and contains the exported characters and connections for every line
+    box, keyed by the box, the baseline and the segmentation parameters.
+    Only lines whose key is not found are segmented again.
+    '''
+
+    def __init__(self, im, cache_dir):
+        import hashlib
+        pagehash = hashlib.sha1(im.image.tobytes()).hexdigest()
+        self.filename = os.path.join(cache_dir, pagehash + SEGMENT_CACHE_EXT)
+        try:
+            with open(self.filename, 'r') as f:
+                self.cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.cache = {}
+        # keep track of used keys, to remove stale entries on save
+        self.used = set()
+
+    def getcharacters(self, im, box=None, baseline=None, c_height=6):
+        key = json.dumps([SEGMENTATION_VERSION, box, baseline, c_height])
+        if key not in self.cache:
+            self.cache[key] = [(char.export(), connections) for char, connections
+                               in getcharacters(im, box, baseline, c_height)]
+        self.used.add(key)
+        return [(loadboundim(char), tuple(connections))
+                for char, connections in self.cache[key]]
+
+    def save(self):
+        cache = {key: self.cache[key] for key in self.used}
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp_file = f'{self.filename}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, self.filename)
 
 def print_new_entries(tables, entries, unit):
     printed = 0
@@ -84,32 +253,103 @@ def get_textsize(linetype, section):
         textsize = 'small'
     return textsize
 
-def findchar(table, char, update_avgim=True, add_to_table=True):
+def findchar(table, char, update_avgim=True, add_to_table=True, compare_args=None,
+             stats=None, freeze_args=None, cold_args=None):
     # table is a list of dicts: {'id': c_id, 'avgim': avgim, 'key': key}
+    # compare_args is a dict with optional arguments for AvgIm.compare()
+    # stats is an optional dict in which the comparisons are counted
+    # freeze_args is a dict with optional arguments for AvgIm.add()
+    # cold_args is a dict with optional values for 'min_pixels' and 'max_age'
     # if char.width >= 10:
     #     char = char.strip_connecting_line()
-    found = False
-    for c in table:
-        offset = c['avgim'].compare(char.image(), char.baseline)
-        if offset:
-            found = c
-            if update_avgim:
-                c['avgim'].add(char.image(), char.baseline, offset)
-            break
-    if not found and add_to_table:
-        found = addtochartable(table, char)
+    return findchars(table, [char], update_avgim, add_to_table, compare_args,
+                     stats, freeze_args, cold_args)[0]
+
+def findchars(table, chars, update_avgim=True, add_to_table=True, compare_args=None,
+              stats=None, freeze_args=None, cold_args=None):
+    """Find a sequence of characters in table, one after the other
+
+    Every character is compared with the entries in order of the table,
+    and matches the first entry that it fits, exactly as with findchar().
+    The table is updated before the next character is looked up. The
+    image of every character is rendered only once, and only entries
+    whose size range contains it are compared.
+
+    Entries with a 'cold' value are in the cold tier, which is only
+    searched when no other entry matches. New entries with fewer than
+    cold_args['min_pixels'] pixels are put in the cold tier ('size'),
+    as are entries that were not matched after cold_args['max_age']
+    pages ('age', see ageentries()), until they are matched.
+
+    Returns:
+        list with the entry of every character
+    """
+    if compare_args is None:
+        compare_args = {}
+    if freeze_args is None:
+        freeze_args = {}
+    inrange_args = {k: v for k, v in compare_args.items() if k == 'deviation'}
+    found = []
+    for char in chars:
+        # plain PIL image, since cropping Im objects is expensive
+        im = char.image().image
+        c = False
+        for entry in itertools.chain((e for e in table if not e.get('cold')),
+                                     (e for e in table if e.get('cold'))):
+            if not entry['avgim'].inrange(im, char.baseline, **inrange_args):
+                continue
+            if stats is not None:
+                stats['compares'] = stats.get('compares', 0) + 1
+            offset = entry['avgim'].compare(im, char.baseline, **compare_args)
+            if offset:
+                c = entry
+                if update_avgim:
+                    c['avgim'].add(im, char.baseline, offset, **freeze_args)
+                if c.get('cold') == 'age':
+                    c['cold'] = None
+                break
+        if not c and add_to_table:
+            c = addtochartable(table, char, im)
+            if (cold_args is not None and cold_args.get('min_pixels') is not None
+                    and count(im) < cold_args['min_pixels']):
+                c['cold'] = 'size'
+        found.append(c)
     return found
 
-def addtochartable(table, char):
+def addtochartable(table, char, im=None):
     # table is a list of dicts: {'id': c_id, 'avgim': avgim, 'key': key}
+    if im is None:
+        im = char.image()
     entry = {
         'id': len(table),
-        'avgim': AvgIm(char.image(), char.baseline),
+        'avgim': AvgIm(im, char.baseline),
         'key': None
         }
     table.append(entry)
     return entry
 
+def ageentries(tables, max_age, page):
+    """Move new entries that were only matched once to the cold tier
+
+    Only entries with a 'page' value, the page on which they were added
+    in this run, are considered. After max_age pages (including that
+    page), entries with only one sample are put in the cold tier, and
+    the 'page' value is removed, so that every entry is changed at most
+    twice. Entries of older tables, of which the number of samples is
+    not known, are never put in the cold tier by age.
+    """
+    for table in tables.values():
+        for entry in table:
+            if 'page' not in entry:
+                continue
+            if entry['page'] > page:
+                # made in an earlier run, that counted the pages anew
+                entry['page'] = page
+            elif page - entry['page'] + 1 >= max_age:
+                del entry['page']
+                if not entry.get('cold') and entry['avgim'].samples == 1:
+                    entry['cold'] = 'age'
+
 def getcharacters(im, box=None, baseline=None, c_height=6, overlaps=None):
     '''Generator object yielding characters'''
     # overlaps is a list of (as yet unimplemented) additional boundaries
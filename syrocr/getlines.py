@@ -1,4 +1,5 @@
-from .images import Im, getboundaries
+import functools
+from .images import Im, getboundaries, openpage
 
 # TODO make consistent use of constants, or not at all
 MAXLINEHEIGHT = 1/4 # If lineheight is higher than 1/4 inch (75px@300dpi),
@@ -8,9 +9,9 @@ LINEDIST_TEXT = 1/3.75 # standard line spacing is 1/3.75 inch (80px@300dpi) #TOD
 LINEDIST_APP = 2/11 # 2/11 inch (ca. 54px@300dpi, 4.6181818 mm)
 
 
-def getlines(filename, dpi=None, verbose=False):
+def getlines(filename, dpi=None, verbose=False, cache_dir=None):
     '''Scan a page and return a list of line objects'''
-    im = Im(filename, dpi)
+    im = openpage(filename, dpi, cache_dir)
     lines = []
     for b in getlineboundaries(im, verbose=verbose):
         box = (0, b[0], im.width, b[1])
@@ -600,52 +601,237 @@ def drawrect(drawcontext, xy, outline=None, width=0):
     points = (x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)
     drawcontext.line(points, fill=outline, width=width)
 
-def drawboxes(filename, lines):
-    from PIL import Image, ImageDraw, ImageFont
-    # define some colours
-    # FOP = full opacity (255), HOP = half opacity (128), TRN = transparent
-    BLACK_FOP = (0,0,0,255)
-    WHITE_FOP = (255,255,255,255)
-    WHITE_TRN = (255,255,255,0)
-    RED_FOP = (255,0,0,255)
-    RED_HOP = (255,0,0,128)
-    GREEN_FOP = (0,255,0,255)
-    GREEN_HOP = (0,255,0,128)
-    # line widths
-    BASELINE_WIDTH = 4
-    SECTLINE_WIDTH = 4
-    # define font
-    FONT_FILE = 'Pillow/Tests/fonts/FreeMono.ttf'
-    FONT_SIZE = 32
-    BASELINE_ADJUST = 26
-    # define sections
-    SECTIONS = ('main', 'marginl', 'marginr')
-
-    # open base image
-    im = Image.open(filename).convert('RGBA')
-
-    # make a blank image for the text, initialized to transparent text color
-    txt = Image.new('RGBA', im.size, WHITE_TRN)
-
-    # get a font
-    fnt = ImageFont.truetype(FONT_FILE, FONT_SIZE, 0)
-    # get a drawing context
-    d = ImageDraw.Draw(txt)
+# colours of the line boxes, as (r, g, b, opacity) tuples. The overlay is
+# drawn in an 'L' image with the palette index offsets defined below,
+# which is added to the page image, reduced to PALETTE_GRAYS grey levels.
+# The palette then contains the colours blended with every grey level,
+# so that no full page RGBA images have to be made and composited.
+PALETTE_GRAYS = 64
+OVERLAY_COLOURS = (
+    None,               # 0: no overlay
+    (0, 255, 0, 128),   # 1: baseline, green, half opacity
+    (255, 0, 0, 128),   # 2: sections, red, half opacity
+    (0, 0, 0, 255),     # 3: text, black, full opacity
+)
+BASELINE_FILL = 1 * PALETTE_GRAYS
+SECTLINE_FILL = 2 * PALETTE_GRAYS
+TEXT_FILL = 3 * PALETTE_GRAYS
+# line widths
+BASELINE_WIDTH = 4
+SECTLINE_WIDTH = 4
+# define font, the first font file that can be found is used
+FONT_FILES = ('Pillow/Tests/fonts/FreeMono.ttf', 'FreeMono.ttf',
+              'DejaVuSansMono.ttf')
+FONT_SIZE = 32
+BASELINE_ADJUST = 26
+# define sections
+SECTIONS = ('main', 'marginl', 'marginr')
+# image formats for preview images, with file extension
+PREVIEW_FORMATS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp'}
+
+@functools.lru_cache(maxsize=None)
+def getfont(size=FONT_SIZE, font_file=None):
+    """Load (and cache) the first available TrueType font"""
+    from PIL import ImageFont
+    for f in (font_file,) if font_file is not None else FONT_FILES:
+        try:
+            return ImageFont.truetype(f, size, 0)
+        except OSError:
+            continue
+    if font_file is not None:
+        raise FileNotFoundError('Font file not found:', font_file)
+    return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=None)
+def getpalette(grays=PALETTE_GRAYS, colours=OVERLAY_COLOURS):
+    """Palette with every overlay colour blended with every grey level"""
+    palette = []
+    for colour in colours:
+        for i in range(grays):
+            grey = i * 255 // (grays - 1)
+            if colour is None:
+                palette.extend((grey, grey, grey))
+            else:
+                *rgb, opacity = colour
+                palette.extend((c * opacity + grey * (255 - opacity)) // 255
+                               for c in rgb)
+    return palette
+
+def previewpage(filename, scale=1, cache_dir=None):
+    """Return page image reduced to grey levels, as base for previews"""
+    from PIL import Image
+    step = 256 // PALETTE_GRAYS
+    if cache_dir is None:
+        page = Image.open(filename).convert('L')
+        lut = [x // step for x in range(256)]
+    else:
+        # the cached page is inverted, invert it back with the lookup table
+        page = openpage(filename, cache_dir=cache_dir).image
+        lut = [(255 - x) // step for x in range(256)]
+    if scale != 1:
+        size = (round(page.width * scale), round(page.height * scale))
+        page = page.resize(size, Image.BILINEAR)
+    return page.point(lut)
+
+def drawboxes(filename, lines, cache_dir=None, scale=1, font_file=None):
+    """Return palette image of page with line boxes drawn on it"""
+    from PIL import Image, ImageChops
+    page = previewpage(filename, scale, cache_dir)
+    overlay = Image.new('L', page.size, 0)
+    drawoverlay(overlay, filename, lines, scale, font_file)
+    im = ImageChops.add(page, overlay)
+    im.putpalette(getpalette())
+    return im
+
+def drawoverlay(overlay, filename, lines, scale=1, font_file=None, offset=(0, 0)):
+    """Draw line boxes on overlay, which may be part of the page at offset"""
+    from PIL import ImageDraw
+    fnt = getfont(max(round(FONT_SIZE * scale), 1), font_file)
+    baseline_width = max(round(BASELINE_WIDTH * scale), 1)
+    sectline_width = max(round(SECTLINE_WIDTH * scale), 1)
+    dx, dy = offset
+    s = lambda v: round(v * scale)
+    d = ImageDraw.Draw(overlay)
+    # no antialiasing, since the overlay values are palette offsets
+    d.fontmode = '1'
 
     # draw filename at top of image
-    d.text((10,10), filename, font=fnt, fill=BLACK_FOP)
+    d.text((s(10) - dx, s(10) - dy), filename, font=fnt, fill=TEXT_FILL)
     for line in lines:
         # draw baseline
-        points = [(0, line['baseline']), (im.width, line['baseline'])]
-        d.line(points, fill=GREEN_HOP, width=BASELINE_WIDTH)
+        y = s(line['baseline']) - dy
+        points = [(-dx, y), (overlay.width, y)]
+        d.line(points, fill=BASELINE_FILL, width=baseline_width)
         for section in SECTIONS:
             # draw sections
             if line[section] is None:
                 continue
-            drawrect(d, line[section], outline=RED_HOP, width=SECTLINE_WIDTH)
+            x1, y1, x2, y2 = (s(v) for v in line[section])
+            box = (x1 - dx, y1 - dy, x2 - dx, y2 - dy)
+            drawrect(d, box, outline=SECTLINE_FILL, width=sectline_width)
         # draw line tag
         tag = f"{line['num']} {line['type']}: {line['baseline']}"
-        t_offset = 10, line['baseline'] - BASELINE_ADJUST
-        d.text(t_offset, tag, font=fnt, fill=BLACK_FOP)
+        t_offset = s(10) - dx, s(line['baseline'] - BASELINE_ADJUST) - dy
+        d.text(t_offset, tag, font=fnt, fill=TEXT_FILL)
+
+def savepreview(im, filename, img_format='png'):
+    """Save preview image, converted to RGB if the format requires it"""
+    import os
+    if img_format != 'png':
+        im = im.convert('RGB')
+    # write to temporary file and replace the preview file with it,
+    # so that image viewers never see a partially written file
+    dirname, basename = os.path.split(filename)
+    tmp_file = os.path.join(dirname, f'.{basename}.{os.getpid()}.tmp')
+    im.save(tmp_file, format=img_format.upper())
+    os.replace(tmp_file, filename)
+
+def renderpreview(source_image, json_file, preview_file,
+                  img_format='png', scale=1, cache_dir=None, font_file=None):
+    """Draw boxes from json_file on source_image and save as preview_file"""
+    import json
+    with open(json_file) as f:
+        lines = json.load(f)
+    im = drawboxes(source_image, lines, cache_dir, scale, font_file)
+    savepreview(im, preview_file, img_format)
+    return preview_file
+
+def renderpreviews(jobs, max_workers=None):
+    """Render previews concurrently
+
+    Arguments:
+        jobs: sequence of tuples with arguments for renderpreview()
+        max_workers: number of processes, default number of cpu's
+
+    Yields:
+        filename of every preview image, in order of completion
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(renderpreview, *job) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+def lineextent(line, width, scale=1, font_file=None):
+    """Return box of the area in which drawoverlay() draws line"""
+    fnt = getfont(max(round(FONT_SIZE * scale), 1), font_file)
+    s = lambda v: round(v * scale)
+    margin = max(round(max(BASELINE_WIDTH, SECTLINE_WIDTH) * scale), 1)
+    y = s(line['baseline'])
+    boxes = [(0, y - margin, width, y + margin)]
+    for section in SECTIONS:
+        if line[section] is not None:
+            x1, y1, x2, y2 = (s(v) for v in line[section])
+            boxes.append((x1 - margin, y1 - margin, x2 + margin, y2 + margin))
+    tag = f"{line['num']} {line['type']}: {line['baseline']}"
+    x, y = s(10), s(line['baseline'] - BASELINE_ADJUST)
+    x1, y1, x2, y2 = fnt.getbbox(tag)
+    boxes.append((x + x1, y + y1, x + x2 + 1, y + y2 + 1))
+    return mergeboxes(boxes)
+
+def changedlines(old_lines, new_lines):
+    """Return lines that are in only one of old_lines and new_lines"""
+    import json
+    key = lambda line: json.dumps(line, sort_keys=True)
+    old_keys = {key(line) for line in old_lines}
+    new_keys = {key(line) for line in new_lines}
+    return ([line for line in old_lines if key(line) not in new_keys]
+            + [line for line in new_lines if key(line) not in old_keys])
+
+def overlaps(box1, box2):
+    return (box1[0] < box2[2] and box2[0] < box1[2]
+            and box1[1] < box2[3] and box2[1] < box1[3])
+
+def watchboxes(source_image, json_file, preview_file, img_format='png',
+               scale=1, cache_dir=None, font_file=None, interval=0.1,
+               verbose=False):
+    """Update preview_file every time json_file is changed
+
+    The page image and the last rendering are kept in memory.
+    When json_file changes, only the regions of the lines that
+    were changed, added or removed are drawn again, after which
+    the preview file is replaced.
+    """
+    import json, os, time
+    from PIL import Image, ImageChops
+
+    page = previewpage(source_image, scale, cache_dir)
+    width, height = page.size
+    mtime = os.stat(json_file).st_mtime_ns
+    with open(json_file) as f:
+        lines = json.load(f)
+    im = drawboxes(source_image, lines, cache_dir, scale, font_file)
+    savepreview(im, preview_file, img_format)
+    if verbose:
+        print(f'Wrote {preview_file}')
 
-    return Image.alpha_composite(im, txt)
+    while True:
+        time.sleep(interval)
+        try:
+            if os.stat(json_file).st_mtime_ns == mtime:
+                continue
+            mtime = os.stat(json_file).st_mtime_ns
+            with open(json_file) as f:
+                new_lines = json.load(f)
+        except (FileNotFoundError, ValueError):
+            # the file is being written, try again later
+            continue
+        start = time.perf_counter()
+        changed = changedlines(lines, new_lines)
+        lines = new_lines
+        for line in changed:
+            x1, y1, x2, y2 = lineextent(line, width, scale, font_file)
+            box = (max(x1, 0), max(y1, 0), min(x2, width), min(y2, height))
+            if box[0] >= box[2] or box[1] >= box[3]:
+                continue
+            # draw all lines crossing the box on an overlay of the box size
+            overlay = Image.new('L', (box[2] - box[0], box[3] - box[1]), 0)
+            redraw = [l for l in lines
+                      if overlaps(lineextent(l, width, scale, font_file), box)]
+            drawoverlay(overlay, source_image, redraw, scale, font_file,
+                        offset=box[:2])
+            im.paste(ImageChops.add(page.crop(box), overlay), box)
+        savepreview(im, preview_file, img_format)
+        if verbose:
+            ms = (time.perf_counter() - start) * 1000
+            print(f'Updated {len(changed)} lines in {preview_file} ({ms:.0f} ms)')
@@ -1,5 +1,7 @@
 import os
 import json
+from .tables import read_keys
+from .textlines import findtextlines, parsetextlines, TEXTLINES_EXTS
 
 
 META = ('+', '|', '-', '{', '}')
@@ -11,9 +13,19 @@ INTERPUNCTION = ('#.', '#:', '#\\', # below the baseline
 LETTERS = ("'", 'b', 'g', 'd', 'h', 'w', 'z', 'H', 'T', 'y', 'k',
     'l', 'm', 'n', 's', '`', 'p', 'S', 'q', 'r', '$', 't')
 BRACKETS = '<>()'
+# increase when changes to get_page() invalidate cached pages
+PAGE_CACHE_VERSION = 1
+PAGE_CACHE_EXT = '.gettext.json'
+
+# arguments of get_page(), set once per worker process by _initpages()
+_page_args = None
 
 
 class Char:
+    # a Char is made for every character of the text, so without
+    # a __dict__ to save memory; the attributes are changed in place
+    __slots__ = ('tr', 'connections', 'script', 'box', 'dist')
+
     def __init__(self, tr, connections, script, box, dist):
         self.tr = tr
         self.connections = connections
@@ -22,6 +34,272 @@ class Char:
         self.dist = dist
 
 
+class Combinations:
+    """Prefix trie of combinations, compiled once for get_textline()
+
+    Every node is a tuple of a dict with the next node per
+    transcription, and a list of the combinations that end at the node,
+    in the order in which they were given.
+    """
+
+    def __init__(self, combinations):
+        self.combinations = combinations
+        self.root = ({}, [])
+        for combination in combinations:
+            node = self.root
+            for tr in combination[0]:
+                node = node[0].setdefault(tr, ({}, []))
+            node[1].append(combination)
+
+    def find(self, trs):
+        """Give the node of sequence of transcriptions trs, or None"""
+        node = self.root
+        for tr in trs:
+            node = node[0].get(tr)
+            if node is None:
+                return None
+        return node
+
+
+class Corrections:
+    """Index of corrections by location, that records their use
+
+    Corrections are given as in the corrections file: as 2-tuples with
+    the location (basename, line number, character position, c_id)
+    of the character to be corrected, and the replacement string.
+    They are looked up by basename, line number and position, after
+    which c_id is checked, so that a correction is not applied to
+    another character if the page was recognized again.
+    """
+
+    def __init__(self, corrections):
+        self.corrections = corrections
+        self.index = {}
+        self.pages = {}
+        for n, ((basename, line_num, pos, c_id), tr) in enumerate(corrections):
+            self.index.setdefault((basename, line_num, pos), []).append(n)
+            self.pages.setdefault(basename, []).append(n)
+        self.used = set()
+        # for corrections with another c_id, the c_id that was found
+        self.found = {}
+
+    def correct(self, basename, line_num, pos, c_id, tr):
+        """Give the corrected transcription of a character"""
+        for n in self.index.get((basename, line_num, pos), ()):
+            correction = self.corrections[n]
+            if correction[0][3] == c_id:
+                tr = correction[1]
+                self.used.add(n)
+            else:
+                self.found[n] = c_id
+        return tr
+
+    def page(self, basename):
+        """Give the numbers of the corrections of a page"""
+        return self.pages.get(basename, [])
+
+    def unused(self):
+        """Give the corrections of which the location was not found"""
+        return [c for n, c in enumerate(self.corrections)
+                if n not in self.used and n not in self.found]
+
+    def mismatched(self):
+        """Give (correction, c_id) tuples of corrections with another c_id"""
+        return [(self.corrections[n], c_id) for n, c_id
+                in sorted(self.found.items()) if n not in self.used]
+
+
+class PageCache:
+    '''Cache of the characters that get_page() gives for every page
+
+    The cache file of a page is named after the page, and contains
+    the characters with a hash of everything they depend on: the
+    textlines file, the keys of the table, the combinations, the
+    corrections of the page and the filters of the pipeline. The use
+    of the corrections of the page is stored too, so that unused and
+    mismatched corrections are still reported for cached pages.
+    '''
+
+    def __init__(self, cache_dir, table, combinations, pipeline):
+        self.cache_dir = cache_dir
+        # the part of the hashed data that is the same for all pages,
+        # as bytes, so that the cache can be passed to worker processes
+        self.common = json.dumps([
+            PAGE_CACHE_VERSION, [c['key'] for c in table],
+            combinations.combinations, pipeline.meta, pipeline.interp,
+            pipeline.diacr, pipeline.space_dist, pipeline.finals,
+            pipeline.brackets]).encode()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, data, corrections):
+        """Give the hash of textlines data and a list of corrections"""
+        import hashlib
+        h = hashlib.sha1(self.common)
+        h.update(data)
+        h.update(json.dumps(corrections).encode())
+        return h.hexdigest()
+
+    def load(self, basename, key):
+        """Give (chars, used, found) stored with key, or None"""
+        try:
+            with open(os.path.join(self.cache_dir, basename + PAGE_CACHE_EXT)) as f:
+                cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if cache['key'] != key:
+            return None
+        chars = [Char(*char) for char in cache['chars']]
+        found = {int(n): c_id for n, c_id in cache['found'].items()}
+        return chars, cache['used'], found
+
+    def save(self, basename, key, chars, used, found):
+        """Store chars and the use of the corrections of the page
+
+        used and found refer to the corrections by their position
+        in the corrections of the page.
+        """
+        filename = os.path.join(self.cache_dir, basename + PAGE_CACHE_EXT)
+        tmp_file = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'key': key, 'used': used, 'found': found,
+                       'chars': [(c.tr, c.connections, c.script, c.box, c.dist)
+                                 for c in chars]}, f)
+        os.replace(tmp_file, filename)
+
+
+class LinePipeline:
+    """The fixes and filters that get_text() applies to every line
+
+    Does the same as replace_dagger(), replace_brackets(),
+    split_brackets(), flip_yudh_sade(), add_spaces(), reverse_line()
+    and, depending on the flags, remove_meta(), remove_interpunction()
+    and remove_diacritics(), in that order, but on the list of
+    characters of a line at once. The results of rstrip_diacr() and of
+    the removal of interpunction and diacritics are remembered per
+    transcription, since there are only few different transcriptions.
+    """
+
+    def __init__(self, meta=False, interp=True, diacr=True,
+                 space_dist=15, finals='KMN', brackets=BRACKETS):
+        self.meta = meta
+        self.interp = interp
+        self.diacr = diacr
+        self.space_dist = space_dist
+        self.finals = finals
+        self.brackets = brackets
+        self.stripped = {}
+        self.removed = {}
+
+    def process(self, chars):
+        """Give list of the processed characters of a line"""
+        chars = list(chars)
+
+        # SOME FIXES TODO MUST BE FIXED IN OTHER WAYS
+        # replace_dagger() and replace_brackets(), see docstrings
+        prev_char = None
+        for char in chars:
+            if char.tr == '!':
+                char.tr = '+'
+            if prev_char is not None:
+                if prev_char.tr == '(' and char.script == '':
+                    prev_char.tr = '<'
+                elif char.tr == ')' and prev_char.script == '':
+                    char.tr = '>'
+            prev_char = char
+
+        # split_brackets() and flip_yudh_sade()
+        flipped = []
+        stack = None
+        for char in chars:
+            if char.script != '' and len(char.tr) > 1:
+                split = [Char(c, char.connections, char.script, char.box, char.dist)
+                         for c in char.tr]
+            else:
+                split = [char]
+            for char in split:
+                if stack is None:
+                    stack = char
+                elif (stack.tr.startswith('S') and stack.box[2] > char.box[2]
+                        and char.tr != '\n'):
+                    flipped.append(char)
+                else:
+                    flipped.append(stack)
+                    stack = char
+        if stack is not None:
+            flipped.append(stack)
+
+        # spaces must be added before reversing the line,
+        # since afterward the order of the characters is
+        # changed, and distance cannot be reliably established
+        spaced = self.add_spaces(flipped)
+
+        # reverse_line(), and the optional filters
+        line = []
+        stack = []
+        for char in reversed(spaced):
+            if ((char.script != '' or (stack and char.tr == ' '))
+                    and char.tr not in self.brackets):
+                stack.append(char)
+                continue
+            elif stack:
+                while stack:
+                    self.append(line, stack.pop())
+            if char.tr in self.brackets and len(char.tr) == 1:
+                char.tr = flip_brackets(char.tr, self.brackets)
+            self.append(line, char)
+        return line
+
+    def add_spaces(self, chars):
+        """Like add_spaces(), but on a list"""
+        space = Char(' ', None, None, None, None)
+        spaced = []
+        prev_end = None
+        for char in chars:
+            c_left, c_right = char.connections
+            x1, y1, x2, y2 = char.box
+            tr = self.stripped.get(char.tr)
+            if tr is None:
+                tr = self.stripped[char.tr] = rstrip_diacr(char.tr)
+            if tr and tr[-1] in self.finals:
+                char.tr = tr[:-1] + tr[-1].lower() + char.tr[len(tr):]
+                prev_end = None
+                spaced.append(space)
+            elif not c_left and prev_end is not None and x1 - prev_end >= self.space_dist:
+                spaced.append(space)
+                prev_end = x2 if not c_right else None
+            else:
+                prev_end = x2 if not c_right else None
+            # manual corrections for overlapping characters:
+            # TODO this must be set in tables, or some other place
+            if prev_end and char.tr.startswith("'"):
+                prev_end -= 10
+            elif prev_end and char.tr.startswith('g'):
+                prev_end -= 20
+            spaced.append(char)
+        return spaced
+
+    def append(self, line, char):
+        """Append char to line, unless it is removed by the filters"""
+        if not self.meta and char.tr in META:
+            return
+        if not (self.interp and self.diacr):
+            tr = self.removed.get(char.tr)
+            if tr is None:
+                tr = self.removed[char.tr] = self.remove(char.tr)
+            char.tr = tr
+        line.append(char)
+
+    def remove(self, tr):
+        """Remove interpunction and diacritics from tr, as configured"""
+        if not self.interp:
+            for symbol in INTERPUNCTION:
+                tr = tr.replace(symbol, '')
+        if not self.diacr:
+            for symbol in DIACRITICS:
+                tr = tr.replace(symbol, '')
+        return tr
+
+
 def verses(*args, inscr=True, spaces_file=None, **kwargs):
     """Get text verse tuples"""
     chars = get_text(*args, **kwargs)
@@ -88,71 +366,113 @@ def chars_to_verses(chars, inscr=True):
     yield join_verse(tag, text)
 
 def get_text(json_textlines_dir, tables_filename,
-    json_texline_ext='_textlines.json',
+    json_texline_ext=None,
     combinations=None, corrections=None,
-    meta=False, interp=True, diacr=True):
+    meta=False, interp=True, diacr=True, max_workers=1, cache_dir=None):
     """Get text from json textlines files and tables
 
+    With max_workers other than 1, the pages are processed in
+    parallel, by max_workers processes (None for the number of cpus),
+    and the characters are yielded in the order of the pages.
+    Textlines files are read in both formats, unless json_texline_ext
+    is given.
+    With cache_dir, the characters of every page are stored in
+    cache_dir, and only pages of which an input changed are
+    processed again (see PageCache).
+
     Yields:
         pass
     """
-    if combinations is None:
-        combinations = []
-    if corrections is None:
-        corrections = []
+    if not isinstance(combinations, Combinations):
+        combinations = Combinations(combinations if combinations is not None else [])
+    if not isinstance(corrections, Corrections):
+        corrections = Corrections(corrections if corrections is not None else [])
 
-    with open(tables_filename, 'r') as f:
-        tables = json.load(f)
+    pipeline = LinePipeline(meta, interp, diacr)
+
+    tables = read_keys(tables_filename)
     # TODO for now we only look at line type 'text',
     # there section 'main', which has always textsize 'normal'.
     # This should be properly set in an argument.
     # table = tables['normal']
     table = tables['small']
+    cache = None
+    if cache_dir is not None:
+        cache = PageCache(cache_dir, table, combinations, pipeline)
+
+    exts = (json_texline_ext,) if json_texline_ext else TEXTLINES_EXTS
+    files = findtextlines(json_textlines_dir, exts)
+    if max_workers == 1:
+        for basename, filename in files.items():
+            yield from get_page(filename, basename, table, combinations,
+                                corrections, pipeline, cache)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers, initializer=_initpages, initargs=(
+            table, combinations, corrections, pipeline, cache)) as executor:
+        for chars, used, found in executor.map(_getpage, files.values(), files):
+            # record the use of the corrections in the worker processes
+            corrections.used.update(used)
+            corrections.found.update(found)
+            yield from chars
+
+def get_page(filename, basename, table, combinations, corrections, pipeline,
+             cache=None):
+    """Get the characters of the lines of the textlines file of page basename
+
+    If cache (a PageCache) has the characters of the page,
+    they are not processed again.
 
-    with os.scandir(json_textlines_dir) as sd:
-        filenames = sorted(f.path for f in sd
-            if f.is_file() and f.name.endswith(json_texline_ext))
-    for filename in filenames:
-        basename = os.path.basename(filename)[:-len(json_texline_ext)]
-        with open(filename, 'r') as f:
-            textlines = json.load(f)
-        file_corrections = [c for c in corrections if c[0][0] == basename]
-
-        for textline in textlines:
-            # TODO for now we only look at line type 'text',
-            # there section 'main'. This should be set in an argument.
-            # if textline['type'] != 'text':
-            if textline['type'] != 'column':
-                continue
+    Returns:
+        list of the characters of all lines, processed by pipeline
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if cache is not None:
+        page_corrections = corrections.page(basename)
+        key = cache.key(data, [corrections.corrections[n] for n in page_corrections])
+        cached = cache.load(basename, key)
+        if cached is not None:
+            page, used, found = cached
+            corrections.used.update(page_corrections[i] for i in used)
+            corrections.found.update(
+                (page_corrections[i], c_id) for i, c_id in found.items())
+            return page
+    textlines = parsetextlines(data, filename)
+
+    page = []
+    for textline in textlines:
+        # TODO for now we only look at line type 'text',
+        # there section 'main'. This should be set in an argument.
+        # if textline['type'] != 'text':
+        if textline['type'] != 'column':
+            continue
 
-            line_corrections = [c for c in file_corrections
-                                if c[0][1] == textline['num']]
-
-            chars = get_textline(table, textline['main'], basename,
-                textline['num'], combinations, line_corrections)
-
-            # SOME FIXES TODO MUST BE FIXED IN OTHER WAYS
-            chars = replace_dagger(chars) # emergency fix, see docstring
-            chars = replace_brackets(chars) # another emergency fix
-            chars = split_brackets(chars)
-            chars = flip_yudh_sade(chars)
-
-            # spaces must be added before reversing the line,
-            # since afterward the order of the characters is
-            # changed, and distance cannot be reliably established
-            chars = add_spaces(chars)
-            chars = reverse_line(chars)
-
-            # apply some optional filters
-            if not meta:
-                chars = remove_meta(chars)
-            if not interp:
-                chars = remove_interpunction(chars)
-            if not diacr:
-                chars = remove_diacritics(chars)
-
-            for char in chars:
-                yield char
+        chars = get_textline(table, textline['main'], basename,
+            textline['num'], combinations, corrections)
+
+        page.extend(pipeline.process(chars))
+    if cache is not None:
+        # the corrections of the page are only used by this page
+        used = [i for i, n in enumerate(page_corrections) if n in corrections.used]
+        found = {i: corrections.found[n] for i, n in enumerate(page_corrections)
+                 if n in corrections.found}
+        cache.save(basename, key, page, used, found)
+    return page
+
+def _initpages(*args):
+    global _page_args
+    _page_args = args
+
+def _getpage(filename, basename):
+    """Run get_page() in a worker process, see _initpages()"""
+    table, combinations, corrections, pipeline, cache = _page_args
+    corrections.used = set()
+    corrections.found = {}
+    chars = get_page(filename, basename, table, combinations, corrections,
+                     pipeline, cache)
+    return chars, corrections.used, corrections.found
 
 def get_textline(table, entries, basename, line_num,
              combinations=None, corrections=None):
@@ -188,11 +508,13 @@ def get_textline(table, entries, basename, line_num,
             must be replaced by a "nun" with seyame, 'n"'.
             The combination tuple: (('n^', '"?'), 'n"')
             The first element can have any number of members.
+            May also be a Combinations object.
         corrections: list of 2-tuples, with first element a tuple,
             containing the location of the symbol to be corrected,
             and the second the replacement string.
             The location is a tuple containing the basename of the
             page/image, line number, character position, and c_id.
+            May also be a Corrections object.
 
     Yields:
         4-tuple: (tr, connections, script, box)
@@ -210,10 +532,10 @@ def get_textline(table, entries, basename, line_num,
         * do something with dist (or not?)
 
     """
-    if combinations is None:
-        combinations = []
-    if corrections is None:
-        corrections = []
+    if not isinstance(combinations, Combinations):
+        combinations = Combinations(combinations if combinations is not None else [])
+    if not isinstance(corrections, Corrections):
+        corrections = Corrections(corrections if corrections is not None else [])
 
     m_stack = [] # stack of potentially matching characters
     l_stack = [] # loop stack
@@ -225,12 +547,7 @@ def get_textline(table, entries, basename, line_num,
         script = table[c_id]['key']['script']
 
         # check if current char is in corrections list
-        for correction in [c for c in corrections
-                            if c[0][0] == basename
-                            and c[0][1] == line_num
-                            and c[0][2] == i
-                            and c[0][3] == c_id]:
-            tr = correction[1]
+        tr = corrections.correct(basename, line_num, i, c_id, tr)
 
         l_stack.append(Char(tr, connections, script, box, dist))
 
@@ -254,34 +571,25 @@ def get_textline(table, entries, basename, line_num,
                     m_stack.clear()
                     continue
                 else:
-                    pos = 0
-                    # copy combinations, to select matching combinations
-                    matches = combinations
-                    while len(m_stack) > pos:
-                        matches = [c for c in matches
-                                   if (len(c[0]) > pos
-                                   and c[0][pos] == m_stack[pos].tr)]
-                        pos += 1
-                    if not matches:
+                    # find the combinations that start with the m_stack
+                    node = combinations.find([e.tr for e in m_stack])
+                    if node is None:
                         raise ValueError('Stack contains unmatched char.')
-                    elif [c for c in matches
-                            if (len(c[0]) > pos + 1
-                            and c[0][pos]) == char.tr]:
+                    node = node[0].get(char.tr)
+                    if node is not None and node[0]:
                         # there are matching combinations with more members than current,
                         # so add current char to m_stack:
                         m_stack.append(char)
                         continue
                     else:
-                        matches = [c for c in matches
-                                    if (len(c[0]) > pos
-                                    and c[0][pos]) == char.tr]
+                        matches = node[1] if node is not None else []
                         if not matches:
                             # first, put current char back on front of l_stack
                             l_stack.insert(0, char)
                             # then, go back on the m_stack to find a shorter match if there is one
                             while m_stack:
-                                trs = [e.tr for e in m_stack]
-                                matches = [c for c in combinations if list(c[0]) == trs]
+                                node = combinations.find([e.tr for e in m_stack])
+                                matches = node[1] if node is not None else []
                                 if len(matches) == 1:
                                     # if one match, yield resulting char
                                     tr = matches[0][1] # get tr override from 2nd element of 'combinations' tuple
@@ -319,7 +627,7 @@ def get_textline(table, entries, basename, line_num,
                             m_stack.clear()
                             continue
 
-            if char.tr.endswith('+') or char.tr in (c[0][0] for c in combinations):
+            if char.tr.endswith('+') or char.tr in combinations.root[0]:
                 m_stack.append(char)
             else:
                 yield char
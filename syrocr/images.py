@@ -1,9 +1,12 @@
-from PIL import Image, ImageOps, ImageChops
+import os
+from PIL import Image, ImageOps, ImageChops, ImageFilter
 
 # TODO make consistent use of constants, or not at all
 DEFAULT_DPI = (300.0, 300.0)
 DEFAULT_MARGIN_GAP = 1/30 # 1/30 inch (10px@300dpi).
 HALFMM = 1/50 # 0.508 mm
+DESCRIPTOR_SIZE = 6 # descriptor() grid of 6x6 density values
+DEVIATION = 2 # default maximum deviation of width, height and baseline in AvgIm
 
 
 ###############################################################################
@@ -16,17 +19,18 @@ class Im:
     # Unfortunately Image.Image cannot be subclassed, so used wrapper
     # with __getattr__() (see https://stackoverflow.com/a/5165352)
 
-    def __init__(self, image='./vts-030_2L.tif', dpi=None):
+    def __init__(self, image='./vts-030_2L.tif', dpi=None, data=None, data_tr=None):
         # Open, convert to RGB (required for invert), and invert image
         # Invert is necessary for getbbox, which cuts off black borders
         if type(image) is str:
             self.image = ImageOps.invert(Image.open(image).convert('L'))
         else:
             self.image = image
-        # save pixel data in a tuple
-        self.data = tuple(self.image.getdata())
-        # save pixel data for transposed image in another tuple
-        self.data_tr = tuple(self.image.transpose(Image.TRANSPOSE).getdata())
+        # pixel data may be given, e.g. when mapped from the page cache
+        if data is None or data_tr is None:
+            data, data_tr = getpixeldata(self.image)
+        self.data = data
+        self.data_tr = data_tr
         # set width, height, dpi
         # self.width = self.image.width
         # self.height = self.image.height
@@ -70,10 +74,7 @@ class Im:
     # methods that change self.image also need to update self.data*
     def paste(self, *args, **kwargs):
         self.image.paste(*args, **kwargs)
-        # save pixel data in a tuple
-        self.data = tuple(self.image.getdata())
-        # save pixel data for transposed image in another tuple
-        self.data_tr = tuple(self.image.transpose(Image.TRANSPOSE).getdata())
+        self.data, self.data_tr = getpixeldata(self.image)
 
     def boundim(self, offset, baseline):
         boundaries = list(list(getboundaries(col)) for col in self.cols())
@@ -82,6 +83,16 @@ class Im:
     def close_gaps(self, box=None, gap=2, section=None):
         return close_im_gaps(self, box, gap, section)
 
+def getpixeldata(image):
+    '''Return pixel data of image and of transposed image'''
+    # for 'L' images, bytes behave like a tuple of ints,
+    # but are much cheaper to make and to slice
+    if image.mode == 'L':
+        return image.tobytes(), image.transpose(Image.TRANSPOSE).tobytes()
+    data = tuple(image.getdata())
+    data_tr = tuple(image.transpose(Image.TRANSPOSE).getdata())
+    return data, data_tr
+
 def getrows(data, width, box, reverse=False):
     x1, y1, x2, y2 = box
     rows = range(y1, y2)
@@ -165,6 +176,77 @@ def closegaps(boundaries, gap=2):
     return newboundaries
 
 
+###############################################################################
+# Page cache
+###############################################################################
+
+# A cached page is a file named after the sha1 hash of the source image,
+# containing a header with the page geometry, followed by the raw bytes
+# of the decoded and inverted 'L' image, and the raw bytes of the
+# transposed image. Both sections are aligned to PAGE_CACHE_ALIGN bytes,
+# so that they can be memory mapped read-only separately, and every stage
+# (getlines, drawboxes, getchars) can use them without decoding the source.
+PAGE_CACHE_MAGIC = b'SYROCR-PAGE-1\n'
+PAGE_CACHE_EXT = '.page'
+PAGE_CACHE_ALIGN = 1 << 16 # multiple of mmap.ALLOCATIONGRANULARITY
+
+def openpage(filename, dpi=None, cache_dir=None):
+    '''Return Im of source image, from the page cache if cache_dir is set'''
+    if cache_dir is None:
+        return Im(filename, dpi)
+    cache_file = os.path.join(cache_dir, filehash(filename) + PAGE_CACHE_EXT)
+    if not os.path.isfile(cache_file):
+        writepagecache(Im(filename), cache_file)
+    return readpagecache(cache_file, dpi)
+
+def filehash(filename):
+    '''Return the sha1 hexdigest of the contents of filename'''
+    import hashlib
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def alignedsize(size, align=PAGE_CACHE_ALIGN):
+    return -(-size // align) * align
+
+def writepagecache(im, cache_file):
+    import json
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    header = PAGE_CACHE_MAGIC + json.dumps({
+        'width': im.width,
+        'height': im.height,
+        'dpi': [float(d) for d in im.dpi],
+    }).encode('ascii') + b'\n'
+    # write to temporary file first, so that concurrent readers
+    # never see a partially written cache file
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        for section in (header, im.data, im.data_tr):
+            f.write(section)
+            f.write(bytes(alignedsize(len(section)) - len(section)))
+    os.replace(tmp_file, cache_file)
+
+def readpagecache(cache_file, dpi=None):
+    import json, mmap
+    with open(cache_file, 'rb') as f:
+        if f.readline() != PAGE_CACHE_MAGIC:
+            raise ValueError(f'Not a page cache file: {cache_file}')
+        header = json.loads(f.readline())
+        size = header['width'] * header['height']
+        # slices of an mmap object are bytes, just like the
+        # pixel data of an Im made from an 'L' image
+        data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ,
+                         offset=PAGE_CACHE_ALIGN)
+        data_tr = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ,
+                            offset=PAGE_CACHE_ALIGN + alignedsize(size))
+    image = Image.frombuffer('L', (header['width'], header['height']),
+                             data, 'raw', 'L', 0, 1)
+    image.info['dpi'] = tuple(header['dpi'])
+    return Im(image, dpi, data, data_tr)
+
+
 ###############################################################################
 # BoundIm class and functions
 ###############################################################################
@@ -213,6 +295,19 @@ class BoundIm:
         '''Combines self and boundim2 and returns as new BoundIm'''
         return combineboundims(self, boundim2)
 
+    def export(self):
+        return {
+            'height': self.height,
+            'offset': self.offset,
+            'baseline': self.baseline,
+            'boundaries': self.boundaries,
+        }
+
+def loadboundim(d):
+    '''Return BoundIm from dict made with BoundIm.export()'''
+    boundaries = [[tuple(b) for b in col] for col in d['boundaries']]
+    return BoundIm(d['height'], tuple(d['offset']), boundaries, d['baseline'])
+
 # strip_connecting_line() methods DEPRECATED
 # (no longer necessary since splitpixelgroup2() removes connecting line)
 #     def strip_connecting_line(self):
@@ -342,7 +437,15 @@ def combineboundims(boundim1, boundim2):
 
 class AvgIm:
 
-    def __init__(self, firstim, baseline, width=None, height=None):
+    # samples is the number of images that were added to the average,
+    # stable the number of consecutive additions that did not change
+    # the black and white image, and if frozen is True, additions only
+    # update the size ranges and the number of samples (see add()).
+    def __init__(self, firstim, baseline, width=None, height=None,
+                 samples=1, stable=0, frozen=False):
+        self.samples = samples
+        self.stable = stable
+        self.frozen = frozen
         if type(firstim) is not str:
             self.bw_im = firstim
             self.bw_offset = (0, 0)
@@ -371,6 +474,9 @@ class AvgIm:
             'height': (self.minheight, self.maxheight),
             'baseline': (self.minbaseline, self.maxbaseline),
             'base64_str': im_to_base64(self.avgim),
+            'samples': self.samples,
+            'stable': self.stable,
+            'frozen': self.frozen,
         }
 
     def blackwhite(self):
@@ -382,7 +488,7 @@ class AvgIm:
         else:
             return maxtoblack(self.avgim)
 
-    def compare(self, im, baseline, deviation=2, maxerror=1, absmax=8):
+    def compare(self, im, baseline, deviation=DEVIATION, maxerror=1, absmax=8):
         # deviation is the maximum amount any of width, height, baseline may be
         #           higher resp. lower than the known maximum or minimum values.
         # maxerror is the maximum error in percentage of the comparison between
@@ -390,16 +496,14 @@ class AvgIm:
         #          contain no more than 1 unmatched pixels after comparison.
         # absmax is the maximum absolute number of unmatched pixels, in order
         #        to prevent larger images to allow for e.g. diacritical dots
-        if (self.minwidth - deviation <= im.width <= self.maxwidth + deviation and
-            self.minheight - deviation <= im.height <= self.maxheight + deviation and
-            self.minbaseline - deviation <= baseline <= self.maxbaseline + deviation):
+        if self.inrange(im, baseline, deviation):
             # how to round up a division:
             # https://bytes.com/topic/python/answers/658718-integer-division#post2615925
             size = min(im.width*im.height, 800)
-            maxdens = -(-(im.width*im.height) // (maxerror*100))
+            maxdens = -(-(im.width*im.height*maxerror) // 100)
             # correct maxdens with absmax if it is too large:
             maxdens = min(maxdens, absmax)
-            dens, offset = compare(self.bw_im, im)
+            dens, offset = compare(self.bw_im, im, maxdens=maxdens)
             if dens <= maxdens:
                 return offset
             else:
@@ -407,7 +511,80 @@ class AvgIm:
         else:
             return False
 
-    def add(self, im, baseline, offset):
+    def match(self, other, deviation=DEVIATION, maxerror=1, absmax=8):
+        """Compare the black and white images of self and AvgIm other
+
+        Like compare(), but with the size ranges of other instead of
+        the size of an image. Returns the offset of other.bw_im
+        relative to self.bw_im, or False.
+        """
+        if self.overlaps(other, deviation):
+            im = other.bw_im
+            maxdens = min(-(-(im.width*im.height*maxerror) // 100), absmax)
+            dens, offset = compare(self.bw_im, im, maxdens=maxdens)
+            if dens <= maxdens:
+                return offset
+        return False
+
+    def overlaps(self, other, deviation=DEVIATION):
+        """Check if the size ranges of self and AvgIm other overlap"""
+        return (other.minwidth <= self.maxwidth + deviation and
+                self.minwidth - deviation <= other.maxwidth and
+                other.minheight <= self.maxheight + deviation and
+                self.minheight - deviation <= other.maxheight and
+                other.minbaseline <= self.maxbaseline + deviation and
+                self.minbaseline - deviation <= other.maxbaseline)
+
+    def merge(self, other, offset, subtract=False):
+        """Add the samples of AvgIm other, with offset from match()
+
+        If subtract is True, the samples of other, which must have been
+        merged before, are removed again, but the size ranges are kept.
+        """
+        # position of other.avgim relative to self.avgim
+        x = self.bw_offset[0] + offset[0] - other.bw_offset[0]
+        y = self.bw_offset[1] + offset[1] - other.bw_offset[1]
+        box = (min(0, x), min(0, y),
+               max(self.avgim.width, x + other.avgim.width),
+               max(self.avgim.height, y + other.avgim.height))
+        otherbox = (box[0] - x, box[1] - y, box[2] - x, box[3] - y)
+        self.stable = 0
+        if subtract:
+            self.samples -= other.samples
+            self.avgim = ImageChops.subtract(self.avgim.crop(box),
+                                             other.avgim.crop(otherbox))
+        else:
+            self.samples += other.samples
+            self.frozen = self.frozen and other.frozen
+            # ImageChops.add() clips the sums at 255, like add()
+            self.avgim = ImageChops.add(self.avgim.crop(box),
+                                        other.avgim.crop(otherbox))
+            self.merge_ranges(other)
+        # update bw_image and bw_offset
+        bw_im = self.blackwhite()
+        bw_bbox = bw_im.getbbox()
+        self.bw_im = bw_im.crop(bw_bbox)
+        self.bw_offset = tuple(bw_bbox[:2])
+
+    def merge_ranges(self, other):
+        """Extend the size ranges of self with those of AvgIm other"""
+        self.minwidth = min(self.minwidth, other.minwidth)
+        self.maxwidth = max(self.maxwidth, other.maxwidth)
+        self.minheight = min(self.minheight, other.minheight)
+        self.maxheight = max(self.maxheight, other.maxheight)
+        self.minbaseline = min(self.minbaseline, other.minbaseline)
+        self.maxbaseline = max(self.maxbaseline, other.maxbaseline)
+
+    def inrange(self, im, baseline, deviation=DEVIATION):
+        """Check if size and baseline of im are within deviation of self"""
+        return (self.minwidth - deviation <= im.width <= self.maxwidth + deviation and
+                self.minheight - deviation <= im.height <= self.maxheight + deviation and
+                self.minbaseline - deviation <= baseline <= self.maxbaseline + deviation)
+
+    def add(self, im, baseline, offset, max_samples=None, max_stable=None):
+        # max_samples and max_stable set the convergence policy: after
+        #          max_samples samples, or after max_stable additions that
+        #          did not change bw_im, the average image is frozen.
         # boring administration ## TODO why not use min()/max()?
         if im.width < self.minwidth:
             self.minwidth = im.width
@@ -421,6 +598,10 @@ class AvgIm:
             self.minbaseline = baseline
         if baseline > self.maxbaseline:
             self.maxbaseline = baseline
+        self.samples += 1
+        if self.frozen:
+            return
+        prev_bw = (self.bw_offset, self.bw_im.size, self.bw_im.tobytes())
 
         # offset is the offset compared with the bw_im.
         # Since that may be smaller than the avgim,
@@ -450,6 +631,14 @@ class AvgIm:
         self.bw_im = bw_im.crop(bw_bbox)
         self.bw_offset = tuple(bw_bbox[:2])
 
+        if prev_bw == (self.bw_offset, self.bw_im.size, self.bw_im.tobytes()):
+            self.stable += 1
+        else:
+            self.stable = 0
+        if ((max_samples is not None and self.samples >= max_samples) or
+            (max_stable is not None and self.stable >= max_stable)):
+            self.frozen = True
+
 
 def base64_to_im(base64string):
     # https://stackoverflow.com/a/26079673
@@ -491,6 +680,14 @@ def add(avgim, im):
 def dens(im):
     return sum(bool(c) for c in im.getdata())
 
+def descriptor(im, size=DESCRIPTOR_SIZE):
+    """Give pixel densities of im scaled down to size x size, as tuple"""
+    return tuple(im.resize((size, size), Image.BOX).getdata())
+
+def distance(descr1, descr2):
+    """Give squared euclidean distance between two descriptors"""
+    return sum((a - b) * (a - b) for a, b in zip(descr1, descr2))
+
 def expandimg(im, dim):
     if type(dim) is int:
         l = t = r = b = dim
@@ -505,7 +702,7 @@ def expandimg(im, dim):
     box = (-l,-t,im.size[0]+r,im.size[1]+b)
     return im.crop(box)
 
-def compare(refim, im, shift=1):
+def compare(refim, im, shift=1, maxdens=None):
     '''
     Compare two images.
 
@@ -516,8 +713,19 @@ def compare(refim, im, shift=1):
     When the smallest possible difference is found, the edges
     are removed with removeedges, so that almost identical images
     should evaluate as identical.
-    Return: image with difference between two images
+
+    If maxdens is given, only whether the difference is more than
+    maxdens is of interest. Then images that differ too much in their
+    number of pixels are rejected without comparing them (see
+    lowerbound()), and the first shift with a difference of no more
+    than maxdens is accepted without removing the edges.
+    Return: number of different pixels, and offset of im
     '''
+    if maxdens is not None:
+        mindens = lowerbound(refim, im)
+        if mindens > maxdens:
+            return mindens, None
+
     # The o_w and o_h values register the relative offset of the widest
     # resp. highest of the images to the other one, so in order to
     # calculate the correct relative offset for im in relation to refim
@@ -550,35 +758,59 @@ def compare(refim, im, shift=1):
             box = (0, -o_h, imh1.width, imh2.height-o_h)
             crop1, crop2 = imh1.crop(box), imh2
             diff = ImageChops.difference(crop1, crop2)
-            difdens = dens(diff)
+            difdens = count(diff)
             if lowdens is None or lowdens > difdens:
                 lowdens = difdens
                 lowdiff = (diff, crop1, crop2)
                 # calculate relative offset, correcting for the shift value
                 offset = ((w_sign*shift - w_sign*o_w), (h_sign*shift - h_sign*o_h))
-#             print(difdens)
-#     diff = removeedges(*lowdiff)
-    # return dens(diff), diff
-#     return lowdiff
-    return dens(removeedges(*lowdiff)), offset
+                # removing the edges can only lower the difference
+                if maxdens is not None and difdens <= maxdens:
+                    return difdens, offset
+    return count(removeedges(*lowdiff)), offset
+
+def lowerbound(refim, im):
+    '''
+    Give the lowest possible result of compare(refim, im)
+
+    After removeedges(), only pixels of one image that are not in the
+    dilation of the other image remain, so at least as many as the
+    first image has more pixels than the dilation, whatever the shift.
+    '''
+    return (max(count(refim) - count(dilate(im)), 0)
+            + max(count(im) - count(dilate(refim)), 0))
 
 def removeedges(diffim, orim1, orim2):
-    '''Remove edge difference'''
-    im=diffim.copy() # do not change original (TODO actually, why not?)
-    for x in range(im.size[0]):
-        for y in range(im.size[1]):
-            if im.getpixel((x,y)):
-                # select image in which this pixel is 0
-                checkedge = orim2 if orim1.getpixel((x,y)) else orim1
-                # from that image, take the surrounding pixels
-                area = checkedge.crop((x-1,y-1,x+2,y+2))
-                # count the non-black pixels
-                neighbours = dens(area)
-                # if there are any, remove the current pixel
-                if neighbours:
-                    im.putpixel((x,y),0)
+    '''Remove edge difference
+
+    A differing pixel is removed if the image in which it is 0 has
+    any non-zero pixels around it, so the pixels that remain are those
+    of one image that are not in the dilation of the other image.
+    '''
+    im1, im2 = nonzero(orim1), nonzero(orim2)
+    return ImageChops.lighter(
+        ImageChops.darker(im1, ImageChops.invert(dilate(im2, crop=True))),
+        ImageChops.darker(im2, ImageChops.invert(dilate(im1, crop=True))))
+
+def nonzero(im):
+    """Give 'L' image with every non-zero pixel set to 255"""
+    return im.point(lambda x: 255 if x else 0, 'L')
+
+def dilate(im, crop=False):
+    """Give image with every pixel set to the maximum of its neighbours
+
+    The image is expanded with one pixel on all sides, so that no
+    pixels are lost, unless crop is True.
+    """
+    im = expandimg(im, 1).filter(ImageFilter.MaxFilter(3))
+    if crop:
+        im = im.crop((1, 1, im.width - 1, im.height - 1))
     return im
 
+def count(im):
+    """Give number of non-zero pixels, like dens(), but faster"""
+    return im.width * im.height - im.histogram()[0]
+
 def imgtable(table, spacing=2, maxwidth=5000):
     im = Image.new('L',(0,0))
     y=0
@@ -0,0 +1,124 @@
+import itertools, os, time
+from .getchars import readglyphs, matchpage, get_textsize, SECTIONS, GLYPHS_EXT
+from .tables import TEXTSIZES, read_keys
+from .textlines import readtextlines, findtextlines
+
+# glyph stores, loaded once per worker process
+_pages = None
+
+
+def sweep(glyphs_files, settings, truth=None, max_workers=None):
+    """Match glyphs_files with every setting in settings, in parallel
+
+    Arguments:
+        glyphs_files: list of glyph store filenames, in page order.
+        settings: list of dicts with arguments for AvgIm.compare().
+        truth: optional list with, per page, the reference labels as
+            returned by getlabels(), to calculate the accuracy.
+        max_workers: number of processes, default number of cpu's.
+
+    Yields:
+        dict with the setting and its results, in order of settings
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers, initializer=_loadpages,
+                             initargs=(glyphs_files,)) as executor:
+        yield from executor.map(runsetting, settings, itertools.repeat(truth))
+
+def _loadpages(glyphs_files):
+    global _pages
+    _pages = [readglyphs(glyphs_file) for glyphs_file in glyphs_files]
+
+def runsetting(compare_args, truth=None, pages=None):
+    """Match all pages with new tables, using compare_args"""
+    if pages is None:
+        pages = _pages
+    tables = {textsize: [] for textsize in TEXTSIZES}
+    stats = {'compares': 0}
+    start = time.perf_counter()
+    textpages = [matchpage(glyphlines, tables, compare_args=compare_args,
+                           stats=stats)
+                 for glyphlines in pages]
+    result = dict(compare_args)
+    result['seconds'] = time.perf_counter() - start
+    result['compares'] = stats['compares']
+    for textsize in TEXTSIZES:
+        result[textsize] = len(tables[textsize])
+    if truth is not None:
+        result['accuracy'] = accuracy(textpages, truth)
+    return result
+
+def getsettings(deviation=(2,), maxerror=(1,), absmax=(8,)):
+    """Return list of all combinations of compare arguments"""
+    return [{'deviation': d, 'maxerror': m, 'absmax': a}
+            for d, m, a in itertools.product(deviation, maxerror, absmax)]
+
+def getlabels(glyphs_file, textlines_file, tables):
+    """Get reference transcriptions for the glyphs in glyphs_file
+
+    The reference is a textlines file of the same page, with ids of
+    entries in tables that have a key. Since glyphs and textlines come
+    from the same segmentation, they are aligned by line and position,
+    and only glyphs with the same box are labeled.
+
+    Returns:
+        dict with (line num, section, position) as key and the
+        transcription of the reference character as value
+    """
+    textlines = {textline['num']: textline
+                 for textline in readtextlines(textlines_file)}
+    labels = {}
+    for line in readglyphs(glyphs_file):
+        textline = textlines.get(line['num'])
+        if textline is None:
+            continue
+        for section in SECTIONS:
+            if not line[section]:
+                continue
+            table = tables[get_textsize(line['type'], section)]
+            for i, ((char, connections), entry) in enumerate(
+                    zip(line[section], textline[section])):
+                c_id, c_connections, tr_override, box = entry
+                x, y = char.offset
+                if list(box) != [x, y, x + char.width, y + char.height]:
+                    continue
+                key = table[c_id]['key']
+                if key is not None:
+                    labels[(line['num'], section, i)] = key['tr']
+    return labels
+
+def accuracy(textpages, truth):
+    """Fraction of labeled glyphs that agree with the label of their entry
+
+    The label of an entry is the most frequent reference label
+    among the glyphs that were matched with it.
+    """
+    from collections import Counter
+    entries = {}
+    for textlines, labels in zip(textpages, truth):
+        for textline in textlines:
+            for section in SECTIONS:
+                textsize = get_textsize(textline['type'], section)
+                for i, (c_id, *rest) in enumerate(textline[section]):
+                    label = labels.get((textline['num'], section, i))
+                    if label is not None:
+                        entries.setdefault((textsize, c_id), Counter())[label] += 1
+    total = sum(sum(c.values()) for c in entries.values())
+    if not total:
+        return None
+    return sum(c.most_common(1)[0][1] for c in entries.values()) / total
+
+def loadtruth(glyphs_files, truth_dir, truth_tables_file, glyphs_ext=GLYPHS_EXT):
+    """Get reference labels for every glyph store from truth_dir"""
+    # only the keys are needed, so the average images are not loaded
+    tables = read_keys(truth_tables_file)
+    textlines_files = findtextlines(truth_dir)
+    truth = []
+    for glyphs_file in glyphs_files:
+        base = os.path.basename(glyphs_file)[:-len(glyphs_ext)]
+        textlines_file = textlines_files.get(base)
+        if textlines_file is not None:
+            truth.append(getlabels(glyphs_file, textlines_file, tables))
+        else:
+            truth.append({})
+    return truth
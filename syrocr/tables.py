@@ -0,0 +1,480 @@
+import json, os
+
+TEXTSIZES = ('normal', 'small')
+CHECKPOINT_EXT = '.checkpoint'
+JOURNAL_EXT = '.journal'
+KEYS_EXT = '.keys.json'
+# the journal is folded into the tables file when it grows larger than
+# JOURNAL_RATIO times the size of the tables file
+JOURNAL_RATIO = 0.5
+# number of nearest entries that every entry is compared with by compact()
+NEIGHBOURS = 8
+
+# per tables file, the state of the files and of the entries at the
+# last load or save, to find the entries that changed since
+_saved = {}
+
+
+def load_tables(tables_file, reset=False):
+    """Load character tables from json file
+
+    The exported 'avgim' value of every entry is converted into
+    an AvgIm object. If reset is True, or if tables_file does
+    not exist, empty tables are returned.
+    """
+    if reset or not os.path.isfile(tables_file):
+        _saved.pop(os.path.realpath(tables_file), None)
+        return {textsize: [] for textsize in TEXTSIZES}
+    tables, complete = readjournal(tables_file)
+    import_tables(tables)
+    if complete:
+        remember(tables, tables_file)
+    return tables
+
+def read_tables(tables_file):
+    """Read tables from json file, without converting the AvgIm objects
+
+    Like load_tables(), the entries in the journal are included.
+    """
+    return readjournal(tables_file)[0]
+
+def import_tables(tables):
+    """Convert the exported 'avgim' values of tables into AvgIm objects"""
+    for textsize in tables:
+        for entry in tables[textsize]:
+            import_entry(entry)
+    return tables
+
+def import_entry(entry):
+    """Convert the exported 'avgim' value of entry into an AvgIm object"""
+    from .images import AvgIm
+    entry['avgim'] = AvgIm(
+        entry['avgim']['base64_str'],
+        entry['avgim']['baseline'],
+        entry['avgim']['width'],
+        entry['avgim']['height'],
+        # not stored in tables made before template freezing
+        entry['avgim'].get('samples', 0),
+        entry['avgim'].get('stable', 0),
+        entry['avgim'].get('frozen', False))
+    return entry
+
+def export_tables(tables):
+    """Return copy of tables with exported AvgIm objects, for json.dump"""
+    return {textsize: [dict(entry, avgim=entry['avgim'].export())
+                       for entry in table]
+            for textsize, table in tables.items()}
+
+def save_tables(tables, tables_file):
+    """Save character tables to json file
+
+    If the tables were loaded from or saved to tables_file before, and
+    the files did not change since, only the entries that were added or
+    changed are appended to a journal next to tables_file. Otherwise,
+    or if the journal grows too large, all tables are written to a
+    temporary file first, which then replaces tables_file, so that
+    tables_file is never incomplete, and the journal is removed.
+    """
+    path = os.path.realpath(tables_file)
+    journal_file = tables_file + JOURNAL_EXT
+    saved = _saved.get(path)
+    if (saved is not None and saved[0] == filestates(tables_file)
+            and all(len(tables.get(textsize, ())) >= len(entries)
+                    for textsize, entries in saved[1].items())):
+        records = []
+        for textsize, table in tables.items():
+            entries = saved[1].get(textsize, [])
+            for n, entry in enumerate(table):
+                if n >= len(entries) or changed(entry, entries[n]):
+                    records.append({'textsize': textsize, 'entry': dict(
+                        entry, avgim=entry['avgim'].export())})
+        if records:
+            lines = [json.dumps(record) for record in records]
+            if not os.path.isfile(journal_file):
+                lines.insert(0, json.dumps(
+                    {'snapshot': filestate(tables_file)}))
+            data = ''.join(line + '\n' for line in lines).encode()
+            fd = os.open(journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        if (not os.path.isfile(journal_file) or os.path.getsize(journal_file)
+                <= JOURNAL_RATIO * os.path.getsize(tables_file)):
+            save_keys(tables, tables_file)
+            remember(tables, tables_file)
+            return
+    writejson(export_tables(tables), tables_file)
+    if os.path.isfile(journal_file):
+        os.remove(journal_file)
+    save_keys(tables, tables_file)
+    remember(tables, tables_file)
+
+def save_keys(tables, tables_file):
+    """Save the keys of all entries to a key file next to tables_file
+
+    The key file contains the size and modification time of tables_file
+    and its journal, so that read_keys() can check that it is current.
+    """
+    writejson({'files': filestates(tables_file),
+               'keys': {textsize: [entry['key'] for entry in table]
+                        for textsize, table in tables.items()}},
+              tables_file + KEYS_EXT)
+
+def read_keys(tables_file):
+    """Read only the ids and keys of the entries in tables_file
+
+    The key file of save_tables() is used if it is current, otherwise
+    tables_file is read with read_tables().
+
+    Returns:
+        tables with for every entry a dict with only 'id' and 'key'
+    """
+    keys_file = tables_file + KEYS_EXT
+    if os.path.isfile(keys_file):
+        with open(keys_file, 'r') as f:
+            keys = json.load(f)
+        if keys['files'] == list(filestates(tables_file)):
+            return {textsize: [{'id': c_id, 'key': key}
+                               for c_id, key in enumerate(table)]
+                    for textsize, table in keys['keys'].items()}
+    return {textsize: [{'id': entry['id'], 'key': entry['key']}
+                       for entry in table]
+            for textsize, table in read_tables(tables_file).items()}
+
+def readjournal(tables_file):
+    """Read tables file, and apply the entries in its journal
+
+    A journal that was made for another version of tables_file is
+    ignored. An incomplete last line, of an interrupted save, is
+    skipped.
+
+    Returns:
+        (tables, complete): tables with exported AvgIm objects, and
+        False if the journal ends with an incomplete line
+    """
+    with open(tables_file, 'r') as f:
+        tables = json.load(f)
+    journal_file = tables_file + JOURNAL_EXT
+    if not os.path.isfile(journal_file):
+        return tables, True
+    with open(journal_file, 'rb') as f:
+        lines = f.read().split(b'\n')
+    if len(lines) < 2 or json.loads(lines[0]) != {'snapshot': filestate(tables_file)}:
+        return tables, False
+    for line in lines[1:-1]:
+        record = json.loads(line)
+        table = tables.setdefault(record['textsize'], [])
+        entry = record['entry']
+        if entry['id'] == len(table):
+            table.append(entry)
+        else:
+            table[entry['id']] = entry
+    return tables, not lines[-1]
+
+def filestate(filename):
+    """Give size and modification time of filename, or None"""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def filestates(tables_file):
+    return filestate(tables_file), filestate(tables_file + JOURNAL_EXT)
+
+def fingerprint(entry):
+    """Give the values of entry that save_tables() checks for changes"""
+    avgim = entry['avgim']
+    values = (json.dumps({k: v for k, v in entry.items() if k != 'avgim'},
+                         sort_keys=True),
+              avgim.samples, avgim.stable, avgim.frozen,
+              avgim.minwidth, avgim.maxwidth, avgim.minheight,
+              avgim.maxheight, avgim.minbaseline, avgim.maxbaseline)
+    # AvgIm methods that change the image replace the avgim attribute
+    return avgim, avgim.avgim, values
+
+def changed(entry, saved):
+    avgim, im, values = fingerprint(entry)
+    return not (avgim is saved[0] and im is saved[1] and values == saved[2])
+
+def remember(tables, tables_file):
+    """Store the state of tables_file and of the entries of tables"""
+    _saved[os.path.realpath(tables_file)] = (
+        filestates(tables_file),
+        {textsize: [fingerprint(entry) for entry in table]
+         for textsize, table in tables.items()})
+
+def save_checkpoint(tables, pages, tables_file):
+    """Save tables and the pages they include to a checkpoint file
+
+    The checkpoint file is stored next to tables_file, and is replaced
+    at once, like save_tables(), so that the tables and the list of
+    pages always belong together.
+    """
+    writejson({'pages': pages, 'tables': export_tables(tables)},
+              tables_file + CHECKPOINT_EXT)
+
+def load_checkpoint(tables_file):
+    """Load the checkpoint of tables_file
+
+    Returns:
+        (tables, pages), or None if there is no checkpoint
+    """
+    checkpoint_file = tables_file + CHECKPOINT_EXT
+    if not os.path.isfile(checkpoint_file):
+        return None
+    with open(checkpoint_file, 'r') as f:
+        checkpoint = json.load(f)
+    return import_tables(checkpoint['tables']), checkpoint['pages']
+
+def remove_checkpoint(tables_file):
+    """Remove the checkpoint of tables_file, if there is one"""
+    checkpoint_file = tables_file + CHECKPOINT_EXT
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+
+def writejson(data, filename):
+    """Write data to json file through a temporary file"""
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_file, filename)
+
+def compact_tables(tables, compare_args=None, neighbours=NEIGHBOURS):
+    """Merge entries of tables that match each other
+
+    Every entry is compared, in both directions, with the preceding
+    entries with overlapping size ranges that are nearest by descriptor.
+    Matching entries are grouped, unless that would group entries with
+    different keys, and every group is merged into its first entry.
+    The AvgIm objects of the first entries are updated.
+
+    Returns:
+        (tables, remap): new tables with consecutive ids, and per
+        textsize a dict with the new id of every old id
+    """
+    from .images import descriptor, compare, DEVIATION
+    if compare_args is None:
+        compare_args = {}
+    deviation = compare_args.get('deviation', DEVIATION)
+    new_tables = {}
+    remap = {}
+    for textsize, table in tables.items():
+        avgims = [entry['avgim'] for entry in table]
+        descriptors = [descriptor(avgim.bw_im) for avgim in avgims]
+        # union-find forest, with the key of every group at its root
+        parent = list(range(len(table)))
+        keys = [entry['key'] for entry in table]
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        # index of entry numbers by all widths in their range
+        index = {}
+        for i, avgim in enumerate(avgims):
+            candidates = nearest_entries(avgim, descriptors[i], index, avgims,
+                                         descriptors, deviation, neighbours)
+            for j in candidates:
+                ri, rj = find(i), find(j)
+                if ri == rj:
+                    continue
+                if (keys[ri] is not None and keys[rj] is not None
+                        and keys[ri] != keys[rj]):
+                    continue
+                if (avgims[j].match(avgim, **compare_args)
+                        and avgim.match(avgims[j], **compare_args)):
+                    root, other = min(ri, rj), max(ri, rj)
+                    parent[other] = root
+                    if keys[root] is None:
+                        keys[root] = keys[other]
+            index_entry(index, i, avgim)
+
+        groups = {}
+        for i in range(len(table)):
+            groups.setdefault(find(i), []).append(i)
+        new_tables[textsize] = []
+        remap[textsize] = {}
+        for root, members in groups.items():
+            entry = dict(table[root], id=len(new_tables[textsize]),
+                         key=keys[root])
+            for i in members[1:]:
+                dens, offset = compare(entry['avgim'].bw_im, avgims[i].bw_im)
+                entry['avgim'].merge(avgims[i], offset)
+            if not all(table[i].get('cold') for i in members):
+                entry.pop('cold', None)
+            if len(members) > 1:
+                # a merged entry has more than one sample, it is not aged
+                entry.pop('page', None)
+            for i in members:
+                remap[textsize][table[i]['id']] = entry['id']
+            new_tables[textsize].append(entry)
+    return new_tables, remap
+
+def merge_tables(inputs, base=None, compare_args=None, neighbours=NEIGHBOURS):
+    """Merge tables that were extended independently
+
+    If base is given, all inputs started from the base tables, and the
+    entries of the base tables keep their ids. Their updates in the
+    inputs are merged, counting the samples of the base entry once, as
+    are the keys that the inputs gave them. A ValueError is raised if
+    two inputs gave an entry different keys.
+    The other entries of the inputs are added in order: an entry with
+    the same black and white image as a merged entry is merged with it,
+    else it is compared, in both directions, with the merged entries
+    with overlapping size ranges that are nearest by descriptor. Entries
+    with different keys are never merged. Entries that do not match are
+    appended. The AvgIm objects of the inputs are updated.
+
+    Arguments:
+        inputs: list of tables, as returned by load_tables().
+        base: tables that all inputs started from, or None.
+        compare_args: dict with optional arguments for AvgIm.compare().
+        neighbours: number of entries to compare every entry with.
+
+    Returns:
+        (tables, remaps): merged tables, and for every input, per
+        textsize a dict with the new id of every old id
+    """
+    from .images import descriptor, compare, DEVIATION
+    if compare_args is None:
+        compare_args = {}
+    if base is None:
+        base = {textsize: [] for textsize in TEXTSIZES}
+    deviation = compare_args.get('deviation', DEVIATION)
+    new_tables = {}
+    remaps = [{} for tables in inputs]
+    textsizes = list(base)
+    textsizes += [t for tables in inputs for t in tables if t not in textsizes]
+    for textsize in dict.fromkeys(textsizes):
+        table = new_tables[textsize] = []
+        tables = [tables.get(textsize, []) for tables in inputs]
+        for remap in remaps:
+            remap[textsize] = {}
+
+        # entries of the base tables, updated in any number of inputs
+        for t in tables:
+            if len(t) < len(base.get(textsize, [])):
+                raise ValueError(f'{textsize} table has fewer entries than the base table')
+        for b_entry in base.get(textsize, []):
+            c_id = b_entry['id']
+            for remap in remaps:
+                remap[textsize][c_id] = c_id
+            i_entries = [t[c_id] for t in tables]
+            changed = [i_entry for i_entry in i_entries
+                       if i_entry['avgim'].samples != b_entry['avgim'].samples]
+            entry = dict(changed[0]) if changed else dict(b_entry)
+            for i_entry in changed[1:]:
+                avgim = entry['avgim']
+                dens, offset = compare(avgim.bw_im, i_entry['avgim'].bw_im)
+                avgim.merge(i_entry['avgim'], offset)
+                dens, offset = compare(avgim.bw_im, b_entry['avgim'].bw_im)
+                avgim.merge(b_entry['avgim'], offset, subtract=True)
+            # also the keys of inputs in which the entry was not matched
+            for i_entry in i_entries:
+                mergeentry(entry, i_entry, b_entry, textsize)
+            table.append(entry)
+
+        # new entries of every input
+        avgims = [entry['avgim'] for entry in table]
+        descriptors = [descriptor(avgim.bw_im) for avgim in avgims]
+        index = {}
+        images = {}
+        for m, avgim in enumerate(avgims):
+            index_entry(index, m, avgim)
+            images.setdefault(bwkey(avgim), m)
+        # entries are only merged with new entries of preceding inputs
+        first = start = len(table)
+        for n, t in enumerate(tables):
+            for i_entry in t[first:]:
+                i_avgim = i_entry['avgim']
+                i_descr = descriptor(i_avgim.bw_im)
+                m = images.get(bwkey(i_avgim))
+                if (m is None or not first <= m < start
+                        or bwkey(avgims[m]) != bwkey(i_avgim)
+                        or not compatible(table[m]['key'], i_entry['key'])):
+                    candidates = nearest_entries(
+                        i_avgim, i_descr, index, avgims, descriptors,
+                        deviation, neighbours)
+                    m = next((m for m in candidates if first <= m < start
+                              and compatible(table[m]['key'], i_entry['key'])
+                              and avgims[m].match(i_avgim, **compare_args)
+                              and i_avgim.match(avgims[m], **compare_args)),
+                             None)
+                if m is None:
+                    m = len(table)
+                    table.append(dict(i_entry, id=m))
+                    avgims.append(i_avgim)
+                    descriptors.append(i_descr)
+                else:
+                    dens, offset = compare(avgims[m].bw_im, i_avgim.bw_im)
+                    avgims[m].merge(i_avgim, offset)
+                    mergeentry(table[m], i_entry, textsize=textsize)
+                    descriptors[m] = descriptor(avgims[m].bw_im)
+                index_entry(index, m, avgims[m])
+                images.setdefault(bwkey(avgims[m]), m)
+                remaps[n][textsize][i_entry['id']] = m
+            start = len(table)
+    return new_tables, remaps
+
+def mergeentry(entry, other, base=None, textsize=None):
+    """Merge key and cold tier of table entry other into entry
+
+    If other is a copy of entry base, its key is only merged if it
+    differs from the key of base. Raises ValueError if other has
+    another key than entry. The merged entry has more than one sample,
+    so it is not aged (see getchars.ageentries()).
+    """
+    key = base['key'] if base is not None else None
+    if other['key'] != key:
+        if entry['key'] != key and entry['key'] != other['key']:
+            raise ValueError(
+                f'Entry {entry["id"]} of {textsize} table has key '
+                f'{entry["key"]} in one input and {other["key"]} in another')
+        entry['key'] = other['key']
+    if not other.get('cold'):
+        entry.pop('cold', None)
+    entry.pop('page', None)
+
+def compatible(key, other):
+    """Check if entries with key and other may be merged"""
+    return key is None or other is None or key == other
+
+def bwkey(avgim):
+    """Give hashable key of the black and white image of avgim"""
+    return (avgim.bw_im.size, avgim.bw_im.tobytes())
+
+def index_entry(index, n, avgim):
+    """Add entry number n to index, for all widths in the range of avgim"""
+    for width in range(avgim.minwidth, avgim.maxwidth + 1):
+        entries = index.setdefault(width, [])
+        if n not in entries:
+            entries.append(n)
+
+def nearest_entries(avgim, descr, index, avgims, descriptors,
+                    deviation, neighbours=NEIGHBOURS):
+    """Give the indexed entries with size ranges overlapping avgim
+
+    Returns:
+        list of at most neighbours entry numbers, nearest by descriptor
+    """
+    from .images import distance
+    candidates = set()
+    for width in range(avgim.minwidth - deviation,
+                       avgim.maxwidth + deviation + 1):
+        candidates.update(index.get(width, ()))
+    candidates = sorted(
+        (j for j in candidates if avgim.overlaps(avgims[j], deviation)),
+        key=lambda j: (distance(descr, descriptors[j]), j))
+    return candidates[:neighbours]
+
+def remap_textlines(textlines, remap):
+    """Replace the ids in textlines with the new ids in remap"""
+    from .getchars import get_textsize, SECTIONS
+    for textline in textlines:
+        for section in SECTIONS:
+            ids = remap[get_textsize(textline['type'], section)]
+            textline[section] = [[ids[c_id]] + list(rest)
+                                 for c_id, *rest in textline[section] or ()]
+    return textlines
@@ -0,0 +1,75 @@
+import gzip, json, os
+
+TEXTLINES_EXT = '_textlines.json'
+# gzipped, with one textline per line in compact json
+COMPACT_TEXTLINES_EXT = '_textlines.jsonl.gz'
+TEXTLINES_EXTS = (TEXTLINES_EXT, COMPACT_TEXTLINES_EXT)
+
+
+def readtextlines(filename):
+    """Read textlines file in the json or the compact format"""
+    with open(filename, 'rb') as f:
+        return parsetextlines(f.read(), filename)
+
+def parsetextlines(data, filename):
+    """Parse the contents data of textlines file filename"""
+    if filename.endswith(COMPACT_TEXTLINES_EXT):
+        data = gzip.decompress(data)
+        # parsed as one array, which is faster than line by line
+        return json.loads(b'[' + b','.join(data.splitlines()) + b']')
+    return json.loads(data)
+
+def writetextlines(filename, textlines):
+    """Write textlines file, in the format of its extension
+
+    A file of the same page in the other format is removed, so that
+    it is not read instead of the new file.
+    """
+    if filename.endswith(COMPACT_TEXTLINES_EXT):
+        data = ''.join(json.dumps(textline, separators=(',', ':')) + '\n'
+                       for textline in textlines)
+        # without a time stamp, the same textlines give the same file
+        with open(filename, 'wb') as f:
+            f.write(gzip.compress(data.encode(), mtime=0))
+    else:
+        with open(filename, 'w') as f:
+            json.dump(textlines, f, indent=2)
+    base, ext = splitext(filename)
+    for other_ext in TEXTLINES_EXTS:
+        if other_ext != ext and os.path.exists(base + other_ext):
+            os.remove(base + other_ext)
+
+def splitext(filename):
+    """Split filename in the part before the textlines extension, and
+    the extension, which is '' for other files"""
+    for ext in TEXTLINES_EXTS:
+        if filename.endswith(ext):
+            return filename[:-len(ext)], ext
+    return filename, ''
+
+def findtextlines(dirname, exts=TEXTLINES_EXTS):
+    """Find textlines files in dirname
+
+    Returns:
+        dict with the path of the textlines file of every page,
+        by the basename of the page, sorted by basename
+    """
+    files = {}
+    with os.scandir(dirname) as sd:
+        for f in sd:
+            for ext in exts:
+                if f.is_file() and f.name.endswith(ext):
+                    files[f.name[:-len(ext)]] = f.path
+                    break
+    return dict(sorted(files.items()))
+
+def convert(dirname, compact=True, verbose=False):
+    """Convert the textlines files in dirname to the compact format,
+    or if compact is False, to the json format"""
+    ext = COMPACT_TEXTLINES_EXT if compact else TEXTLINES_EXT
+    for base, filename in findtextlines(dirname).items():
+        if filename.endswith(ext):
+            continue
+        writetextlines(os.path.join(dirname, base + ext), readtextlines(filename))
+        if verbose:
+            print(os.path.basename(filename), '->', base + ext)
@@ -0,0 +1,307 @@
+import contextlib, json, os, socket, time
+from .tables import load_tables, save_tables, export_tables, import_entry
+from .tables import merge_tables, KEYS_EXT
+
+# seconds between checks of lock files and of pages of other workers
+POLL_INTERVAL = 0.1
+WAIT_INTERVAL = 5
+# seconds after which a lock file is considered stale
+LOCK_TIMEOUT = 60
+BASE_FILE = 'base.json'
+LOG_FILE = 'entries.log'
+LOCK_FILE = 'entries.lock'
+FINISH_FILE = 'finish.lock'
+
+
+class WorkQueue:
+    '''Distribute pages over workers that share only a directory
+
+    Every stage (such as 'getlines' or 'getchars') has its own
+    subdirectory of the queue directory. Every worker claims pages by
+    creating a lock file in the claims directory, which only one worker
+    can do, and marks them as done in the done directory when their
+    output is written.
+
+    Workers that match characters share their tables through an
+    append-only log of new entries. The tables that all workers start
+    from are stored next to it. Before every page, a worker
+    appends the entries that other workers published to its tables.
+    After the page, it publishes the entries that it added, which get
+    the next ids in the log; the ids in the textlines of the page are
+    changed accordingly (see publish()). When all pages are done,
+    every worker stores its tables, and the last one merges them.
+    '''
+
+    def __init__(self, queue_dir, stage, worker=None):
+        self.stage_dir = os.path.join(queue_dir, stage)
+        self.worker = worker if worker else f'{socket.gethostname()}-{os.getpid()}'
+        self.claims_dir = os.path.join(self.stage_dir, 'claims')
+        self.done_dir = os.path.join(self.stage_dir, 'done')
+        self.workers_dir = os.path.join(self.stage_dir, 'workers')
+        self.tables_dir = os.path.join(self.stage_dir, 'tables')
+        for d in (self.claims_dir, self.done_dir, self.workers_dir, self.tables_dir):
+            os.makedirs(d, exist_ok=True)
+        self.log_file = os.path.join(self.stage_dir, LOG_FILE)
+        self.offset = 0
+
+    def claim(self, names, wait=False, verbose=False):
+        """Yield the names that are not done and could be claimed
+
+        The claim of a worker on this host that is no longer running
+        is released, and the name is claimed again. With wait, keep
+        waiting until all names are done, and yield the names of which
+        the claims are released in the meantime; the workers that hold
+        the claims of the other names are reported when they change.
+        """
+        reported = None
+        while True:
+            for name in names:
+                if os.path.exists(os.path.join(self.done_dir, name)):
+                    continue
+                claim_file = os.path.join(self.claims_dir, name)
+                if createfile(claim_file, self.worker):
+                    yield name
+                    continue
+                owner = readfile(claim_file)
+                if (owner is not None and not isalive(owner)
+                        and removestale(claim_file, owner, self.worker)
+                        and createfile(claim_file, self.worker)):
+                    yield name
+            if not wait:
+                return
+            waiting = [name for name in names if not os.path.exists(
+                os.path.join(self.done_dir, name))]
+            if not waiting:
+                return
+            owners = sorted(set(filter(None, (
+                readfile(os.path.join(self.claims_dir, name))
+                for name in waiting))))
+            if owners != reported:
+                print(f'Waiting for {len(waiting)} pages claimed by '
+                      f'{", ".join(owners)}. If a worker crashed, remove '
+                      f'its claims from {self.claims_dir}.')
+                reported = owners
+            elif verbose:
+                print(f'Waiting for {len(waiting)} pages of other workers')
+            time.sleep(WAIT_INTERVAL)
+
+    def complete(self, name):
+        """Mark claimed name as done"""
+        createfile(os.path.join(self.done_dir, name), self.worker)
+
+    def start(self, tables_file, reset=False):
+        """Register worker and load the tables of the queue
+
+        The first worker stores the tables in tables_file (or empty
+        tables if reset is True) as the tables all workers start from.
+        Returns the tables with all entries published so far.
+        """
+        createfile(os.path.join(self.workers_dir, self.worker), self.worker)
+        base_file = os.path.join(self.stage_dir, BASE_FILE)
+        if not os.path.exists(base_file):
+            tables = export_tables(load_tables(tables_file, reset=reset))
+            createfile(base_file, json.dumps(tables))
+        tables = load_tables(base_file)
+        self.update(tables)
+        return tables
+
+    def update(self, tables):
+        """Append the entries published by other workers to tables"""
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # skip an incomplete last line, it is read again next time
+        data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        for line in data.splitlines():
+            record = json.loads(line)
+            table = tables[record['textsize']]
+            entry = import_entry(record['entry'])
+            if entry['id'] != len(table):
+                raise ValueError(f'{self.log_file} does not match the tables')
+            table.append(entry)
+
+    def publish(self, tables, num_entries):
+        """Publish the entries in tables after num_entries in the log
+
+        The published entries follow the entries that other workers
+        published in the meantime, which are inserted before them.
+
+        Returns:
+            per textsize a dict with the new id of every old id, for
+            remap_textlines()
+        """
+        new = {}
+        for textsize, table in tables.items():
+            new[textsize] = table[num_entries[textsize]:]
+            del table[num_entries[textsize]:]
+        remap = {}
+        with self.lock():
+            self.update(tables)
+            lines = []
+            for textsize, table in tables.items():
+                remap[textsize] = {i: i for i in range(num_entries[textsize])}
+                for entry in new[textsize]:
+                    remap[textsize][entry['id']] = len(table)
+                    entry['id'] = len(table)
+                    table.append(entry)
+                    lines.append(json.dumps({
+                        'textsize': textsize,
+                        'entry': dict(entry, avgim=entry['avgim'].export())}))
+            if lines:
+                data = ''.join(line + '\n' for line in lines).encode()
+                fd = os.open(self.log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+                self.offset += len(data)
+        return remap
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the lock file of the log
+
+        A lock file that is older than LOCK_TIMEOUT seconds, or of
+        which the worker is no longer running, is removed.
+        """
+        lock_file = os.path.join(self.stage_dir, LOCK_FILE)
+        while not createfile(lock_file, self.worker):
+            self.breaklock(lock_file)
+            time.sleep(POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            # unless another worker broke the lock in the meantime
+            if readfile(lock_file) == self.worker:
+                os.remove(lock_file)
+
+    def breaklock(self, lock_file):
+        """Remove lock_file if it is stale, see lock()"""
+        owner = readfile(lock_file)
+        try:
+            age = time.time() - os.path.getmtime(lock_file)
+        except FileNotFoundError:
+            return
+        if owner is not None and (age >= LOCK_TIMEOUT or not isalive(owner)):
+            removestale(lock_file, owner, self.worker)
+
+    def pending(self):
+        """Give the registered workers that did not store their tables
+
+        Workers on this host that are no longer running are deregistered
+        (as are workers of which the file in the workers directory is
+        removed by hand).
+        """
+        pending = []
+        for worker in sorted(os.listdir(self.workers_dir)):
+            if worker.endswith('.tmp') or os.path.exists(
+                    os.path.join(self.tables_dir, worker + '.json')):
+                continue
+            if isalive(worker):
+                pending.append(worker)
+            else:
+                os.remove(os.path.join(self.workers_dir, worker))
+        return pending
+
+    def finish(self, tables, tables_file):
+        """Store the tables of this worker, and merge those of all workers
+
+        Must be called after all pages are done. The last worker to
+        store its tables merges them into tables_file, with the tables
+        of all workers that stored them, also of deregistered workers.
+
+        Returns:
+            True if this worker merged the tables
+        """
+        self.update(tables)
+        worker_file = os.path.join(self.tables_dir, self.worker + '.json')
+        save_tables(tables, worker_file)
+        if self.pending():
+            return False
+        worker_files = sorted(
+            os.path.join(self.tables_dir, name)
+            for name in os.listdir(self.tables_dir)
+            if name.endswith('.json') and not name.endswith(KEYS_EXT))
+        if not createfile(os.path.join(self.tables_dir, FINISH_FILE), self.worker):
+            return False
+        # the entries of the log, as they were published, are the base
+        # tables that the tables of all workers have in common
+        base = load_tables(os.path.join(self.stage_dir, BASE_FILE))
+        self.offset = 0
+        self.update(base)
+        new_tables, remaps = merge_tables(
+            [load_tables(f) for f in worker_files], base)
+        save_tables(new_tables, tables_file)
+        return True
+
+
+def readfile(filename):
+    """Give the text of filename, or None if it does not exist"""
+    try:
+        with open(filename) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def removestale(filename, owner, worker):
+    """Remove filename of owner, if it was not replaced in the meantime
+
+    The file is renamed first, so that only one worker removes it. If
+    it turns out to be another file, it is put back.
+
+    Returns:
+        True if the file of owner was removed
+    """
+    stale_file = f'{filename}.{worker}.stale'
+    try:
+        os.rename(filename, stale_file)
+    except FileNotFoundError:
+        return False
+    removed = readfile(stale_file) == owner
+    if not removed:
+        try:
+            os.link(stale_file, filename)
+        except FileExistsError:
+            pass
+    os.remove(stale_file)
+    return removed
+
+def isalive(worker):
+    """Check if worker is running, if it is a worker on this host
+
+    Workers with another name than the default, or on another host,
+    are assumed to be running.
+    """
+    host, _, pid = worker.rpartition('-')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def createfile(filename, text=''):
+    """Create file with text, if it does not exist yet
+
+    The file is written under a temporary name and then linked to
+    filename, so that it is complete when it appears.
+
+    Returns:
+        True if the file was created
+    """
+    tmp_file = f'{filename}.{socket.gethostname()}-{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(text)
+    try:
+        os.link(tmp_file, filename)
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_file)
+    return True